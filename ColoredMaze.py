@@ -1,5 +1,6 @@
 import sys
 import random
+import struct
 import numpy as np
 
 # Author: Ben Williams '25
@@ -11,10 +12,43 @@ import numpy as np
 
 
 # An implementation of a maze that allows spaces to be colored
+# The maze is stored as numpy arrays rather than as characters: a uint8 code for every space (its index into COLORS,
+#   or WALL_CODE for a wall), a boolean floor mask, and a table of the neighbour of every space in each direction
 class ColoredMaze:
-    def __init__(self, maze_file_loc):
+    __slots__ = ("width", "height", "robot_loc", "color_codes", "_floor_mask", "_neighbour_table", "_maze_map")
+
+    # The color sensor reads the right color 88% of the time, and each of the other three colors 4% of the time
+    SENSOR_ACCURACY = 0.88
+    SENSOR_ERROR = 0.04
+
+    COLORS = ("r", "g", "b", "y")
+    WALL = "#"
+    WALL_CODE = len(COLORS)
+    # The columns of the neighbour table
+    DIRECTIONS = ("N", "E", "S", "W")
+
+    # Binary maze files start with this, followed by the rest of BINARY_HEADER. See save_binary for the layout
+    BINARY_MAGIC = b"CMAZEBIN"
+    BINARY_VERSION = 1
+    # magic, version, offset of the spaces, width, height, number of robots
+    BINARY_HEADER = struct.Struct("<8sIIQQQ")
+    # The spaces start on a multiple of this many bytes
+    BINARY_ALIGNMENT = 64
+
+    # Loads a maze file, in either the text format (like the ones in ./mazes) or the binary format
+    # The spaces of a text maze are always checked as they are read. Checking a binary maze reads every page of the
+    #   file, so it is only done with validate=True (see validate_spaces)
+    def __init__(self, maze_file_loc, validate=False):
         self.robot_loc = []
         try:
+            with open(maze_file_loc, "rb") as f:
+                is_binary = f.read(len(self.BINARY_MAGIC)) == self.BINARY_MAGIC
+            if is_binary:
+                self._load_binary(maze_file_loc)
+                if validate:
+                    self.validate_spaces()
+                return
+
             with open(maze_file_loc, "r") as f:
                 lines = []
                 for line in f:
@@ -34,14 +68,177 @@ class ColoredMaze:
                     else:
                         lines.append(line)
 
-                self.width = len(lines[0])
-                self.height = len(lines)
-                self.maze_map = list("".join(lines))
+                width = len(lines[0])
+                height = len(lines)
+                self._set_spaces(self.encode_spaces("".join(lines)), width, height)
         except FileNotFoundError:
             print(f'File {maze_file_loc} not found', file=sys.stderr)
-            self.width = 0
-            self.height = 0
-            self.maze_map = []
+            self._set_spaces(np.zeros(0, dtype=np.uint8), 0, 0)
+
+    # Binary maze file layout (all numbers little endian):
+    #   BINARY_HEADER: the magic, the format version, the byte offset of the spaces, width, height and the number of
+    #       robots, padded with zeros up to the offset of the spaces
+    #   width * height uint8 space codes (indices into COLORS, or WALL_CODE), in the same order as the maze map
+    #   2 int64s (x, y) for every robot
+    def save_binary(self, maze_file_loc):
+        num_robots = len(self.robot_loc) // 2
+        with open(maze_file_loc, "wb") as f:
+            f.write(self._binary_header(self.width, self.height, num_robots))
+            f.write(np.ascontiguousarray(self.color_codes).data)
+            f.write(np.array(self.robot_loc[:2 * num_robots], dtype="<i8").tobytes())
+
+    # Converts a text maze file into a binary one. The text file is read one line at a time and the spaces are
+    #   written out in chunks of about chunk_size bytes, so neither file ever has to fit in memory
+    @classmethod
+    def convert_text_to_binary(cls, text_file_loc, binary_file_loc, chunk_size=1 << 20):
+        robot_loc = []
+        width = None
+        height = 0
+        chunk = []
+        chunk_bytes = 0
+        with open(text_file_loc, "r") as text_file, open(binary_file_loc, "wb") as binary_file:
+            # The size is not known until the end, so the header is written again once it is
+            binary_file.write(cls._binary_header(0, 0, 0))
+            for line in text_file:
+                line = line.strip()
+
+                # Ignore blank lines
+                if len(line) == 0:
+                    pass
+                # Robot command
+                elif line[0] == "\\":
+                    params = line.split()
+                    robot_loc.append(int(params[1]))
+                    robot_loc.append(int(params[2]))
+                else:
+                    if width is None:
+                        width = len(line)
+                    elif len(line) != width:
+                        raise ValueError(f"Line {height + 1} of the maze has {len(line)} spaces instead of {width}")
+                    height += 1
+                    chunk.append(line)
+                    chunk_bytes += width
+                    if chunk_bytes >= chunk_size:
+                        binary_file.write(cls.encode_spaces("".join(chunk)).data)
+                        chunk = []
+                        chunk_bytes = 0
+
+            binary_file.write(cls.encode_spaces("".join(chunk)).data)
+            binary_file.write(np.array(robot_loc, dtype="<i8").tobytes())
+            binary_file.seek(0)
+            binary_file.write(cls._binary_header(width or 0, height, len(robot_loc) // 2))
+
+    # Memory maps the spaces of a binary maze file, so they are read straight from the file without being copied
+    def _load_binary(self, maze_file_loc):
+        with open(maze_file_loc, "rb") as f:
+            magic, version, data_offset, width, height, num_robots = \
+                self.BINARY_HEADER.unpack(f.read(self.BINARY_HEADER.size))
+        if version != self.BINARY_VERSION:
+            raise ValueError(f"Binary maze version {version} is not supported (expected {self.BINARY_VERSION})")
+
+        num_spaces = width * height
+        if num_spaces > 0:
+            color_codes = np.memmap(maze_file_loc, dtype=np.uint8, mode="r", offset=data_offset, shape=(num_spaces,))
+        else:
+            color_codes = np.zeros(0, dtype=np.uint8)
+        if num_robots > 0:
+            robot_loc = np.memmap(maze_file_loc, dtype="<i8", mode="r", offset=data_offset + num_spaces,
+                                  shape=(2 * num_robots,))
+            self.robot_loc = [int(value) for value in robot_loc]
+        self._set_spaces(color_codes, width, height)
+
+    # Raises a ValueError if any space code is not an index into COLORS or WALL_CODE, e.g. from a damaged binary file
+    def validate_spaces(self):
+        invalid = self.color_codes > self.WALL_CODE
+        if invalid.any():
+            raise ValueError(f"Invalid maze space codes {np.unique(self.color_codes[invalid])[:5]}")
+
+    @classmethod
+    def _binary_header(cls, width, height, num_robots):
+        data_offset = -(-cls.BINARY_HEADER.size // cls.BINARY_ALIGNMENT) * cls.BINARY_ALIGNMENT
+        header = cls.BINARY_HEADER.pack(cls.BINARY_MAGIC, cls.BINARY_VERSION, data_offset, width, height, num_robots)
+        return header.ljust(data_offset, b"\0")
+
+    # Makes a maze straight from an array of space codes (indices into COLORS, or WALL_CODE), in the same order as
+    #   the lines of a maze file
+    @classmethod
+    def from_codes(cls, color_codes, width, height, robot_loc=()):
+        colored_maze = cls.__new__(cls)
+        colored_maze.robot_loc = list(robot_loc)
+        colored_maze._set_spaces(color_codes, width, height)
+        return colored_maze
+
+    @classmethod
+    # Turn a string (or bytes) of maze characters into a uint8 array of space codes
+    def encode_spaces(cls, spaces):
+        if isinstance(spaces, str):
+            spaces = spaces.encode("ascii")
+        raw = np.frombuffer(spaces, dtype=np.uint8)
+        codes = _SPACE_CODES[raw]
+        if (codes == _INVALID_SPACE).any():
+            raise ValueError(f"Invalid maze spaces in {bytes(raw[codes == _INVALID_SPACE][:5])}")
+        return codes
+
+    def _set_spaces(self, color_codes, width, height):
+        color_codes = np.asarray(color_codes, dtype=np.uint8)
+        if color_codes.shape != (width * height,):
+            raise ValueError(f"Expected {width * height} maze spaces, got {color_codes.size}")
+        self.width = width
+        self.height = height
+        self.color_codes = color_codes
+        # Built the first time they are needed, so that opening a (memory mapped) maze does not touch every space
+        self._floor_mask = None
+        self._neighbour_table = None
+        self._maze_map = None
+
+    # Boolean array of which spaces are floors
+    @property
+    def floor_mask(self):
+        if self._floor_mask is None:
+            self._floor_mask = self.color_codes != self.WALL_CODE
+        return self._floor_mask
+
+    # The (w * h, 4) array from _build_neighbour_table
+    @property
+    def neighbour_table(self):
+        if self._neighbour_table is None:
+            self._neighbour_table = self._build_neighbour_table()
+        return self._neighbour_table
+
+    # Returns a (w * h, 4) array where column i holds the index of the space one step in DIRECTIONS[i] from every
+    #   space, or the space itself if that step hits a wall or the edge of the maze
+    def _build_neighbour_table(self):
+        num_spaces = self.width * self.height
+        # int32 indices take half the memory of int64 ones whenever they are big enough
+        dtype = np.int32 if num_spaces < 2 ** 31 else np.int64
+        indices = np.arange(num_spaces, dtype=dtype)
+        floor_grid = np.reshape(self.floor_mask, (self.height, self.width))
+
+        neighbour_table = np.empty((num_spaces, len(self.DIRECTIONS)), dtype=dtype)
+        for i, direction in enumerate(self.DIRECTIONS):
+            # Rows go from the top of the maze down, so moving North (up) is moving back one whole row in the index
+            x_mov, y_mov = self._direction_offset(direction)
+            open_grid = np.zeros((self.height, self.width), dtype=bool)
+            if direction == "N":
+                open_grid[1:, :] = floor_grid[:-1, :]
+            elif direction == "E":
+                open_grid[:, :-1] = floor_grid[:, 1:]
+            elif direction == "S":
+                open_grid[:-1, :] = floor_grid[1:, :]
+            elif direction == "W":
+                open_grid[:, 1:] = floor_grid[:, :-1]
+            neighbour_table[:, i] = np.where(open_grid.ravel(), indices + (x_mov - y_mov * self.width), indices)
+
+        return neighbour_table
+
+    # The maze as a list of one character per space, like the lines of the maze file joined together
+    # Built the first time it is needed and then shared by every caller, so copy it before changing it (changing it
+    #   never changes the maze, which only reads color_codes)
+    @property
+    def maze_map(self):
+        if self._maze_map is None:
+            self._maze_map = _SPACE_CHAR_ARRAY[self.color_codes].tolist()
+        return self._maze_map
 
     # Returns the index value in the maze map based on x, y coordinates
     def index(self, x, y):
@@ -54,13 +251,13 @@ class ColoredMaze:
         if y < 0 or y >= self.height:
             return None
 
-        loc = self.index(x, y)
+        code = self.color_codes[self.index(x, y)]
 
         # Wall space
-        if self.maze_map[loc] == "#":
+        if code == self.WALL_CODE:
             return None
         else:
-            return self.maze_map[loc]
+            return self.COLORS[code]
 
     # Returns a boolean of whether the location is a floor space (True) or a wall (False)
     # Takes x, y coordinates as parameters
@@ -70,7 +267,7 @@ class ColoredMaze:
         if y < 0 or y >= self.height:
             return False
 
-        return self.maze_map[self.index(x, y)] != "#"
+        return bool(self.floor_mask[self.index(x, y)])
 
     # Returns a boolean of whether the location is a floor space (True) or a wall (False)
     # Takes an index as parameter
@@ -78,7 +275,221 @@ class ColoredMaze:
         if index < 0 or index >= self.width * self.height:
             return False
 
-        return self.maze_map[index] != "#"
+        return bool(self.floor_mask[index])
+
+    # Returns a boolean (height, width) numpy array of which spaces are floors. Rows are in the same order as
+    #   the maze map, so the top row of the maze (y = height - 1) is row 0
+    def get_floor_grid(self):
+        return np.reshape(self.floor_mask, (self.height, self.width))
+
+    # Returns a boolean (height, width) numpy array of the spaces that have a floor space next to them in the given
+    #   direction, i.e. the spaces where a move in that direction does not hit a wall or the edge of the maze
+    def get_open_direction_grid(self, direction):
+        if direction not in self.DIRECTIONS:
+            return np.zeros((self.height, self.width), dtype=bool)
+        targets = self.neighbour_table[:, self.DIRECTIONS.index(direction)]
+        return np.reshape(targets != np.arange(self.width * self.height), (self.height, self.width))
+
+    # Splits the floor spaces into connected components, the groups of spaces that the robot can move between
+    # Returns (labels, number of components), where labels holds the component of every space in the maze (-1 for
+    #   walls). Components are numbered in the order of their first space in the maze map
+    # This is union-find over the edges between neighbouring floor spaces, done for all the edges at once: every
+    #   round hooks the root of each edge's larger side onto the smaller root, then compresses every path, until no
+    #   edge joins two different roots
+    def get_connected_components(self):
+        num_spaces = self.width * self.height
+        indices = np.arange(num_spaces)
+        floor = self.floor_mask
+
+        # Every edge once, going East or South from a floor space (the neighbour of a floor space is a floor space)
+        starts = []
+        ends = []
+        for direction in ["E", "S"]:
+            targets = self.neighbour_table[:, self.DIRECTIONS.index(direction)]
+            has_edge = floor & (targets != indices)
+            starts.append(indices[has_edge])
+            ends.append(targets[has_edge])
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+
+        parent = indices.copy()
+        while True:
+            # Path compression: point every space straight at its root
+            grandparent = parent[parent]
+            while not np.array_equal(grandparent, parent):
+                parent = grandparent
+                grandparent = parent[parent]
+
+            start_roots = parent[starts]
+            end_roots = parent[ends]
+            joins = start_roots != end_roots
+            if not joins.any():
+                break
+            # Union: hook the larger root onto the smallest root it is joined to
+            np.minimum.at(parent, np.maximum(start_roots[joins], end_roots[joins]),
+                          np.minimum(start_roots[joins], end_roots[joins]))
+
+        # Every root is the first space of its component, so numbering the roots in order numbers the components
+        labels = np.full(num_spaces, -1, dtype=np.intp)
+        roots, labels[floor] = np.unique(parent[floor], return_inverse=True)
+        return labels, len(roots)
+
+    # Splits the floor spaces into the coarsest partition of blocks where every space in a block has the same color,
+    #   and the same chance of moving into each block (the coarsest bisimulation of the sensor and movement model)
+    # Filtering with beliefs that are even over each block keeps them even over each block, so the filter can run
+    #   on one probability per block instead of one per space
+    # With directional=True every space in a block also moves into the same block for each of the 4 directions, so
+    #   known moves can be filtered on the blocks too. Otherwise only random moves are, and blocks can be coarser
+    # Returns (labels, number of blocks), where labels holds the block of every space in the maze (-1 for walls).
+    #   Blocks are numbered in the order of their first space in the maze map
+    # This is worklist partition refinement (Hopcroft's algorithm, or Paige and Tarjan's for the random moves): start
+    #   from the colors, and split blocks by how their spaces move into the blocks on the worklist (splitters). Only
+    #   the spaces that move into a splitter are looked at. When a block is split, every piece but the biggest goes on
+    #   the worklist, since moves into the biggest piece are the moves into the whole block minus the moves into the
+    #   others. Every space ends up in a splitter at most log2(number of floor spaces) times, so this takes
+    #   O(w * h * log(w * h)). All of the splitters on the worklist are used at once in each round
+    def get_bisimulation_partition(self, directional=True):
+        labels = np.full(self.width * self.height, -1, dtype=np.intp)
+        floor_indices = np.flatnonzero(self.floor_mask)
+        num_floor = len(floor_indices)
+        if num_floor == 0:
+            return labels, 0
+        num_directions = len(self.DIRECTIONS)
+
+        # Every move of every floor space, between floor ids, grouped by where it goes: the moves into floor space t
+        #   come from move_sources[move_starts[t]:move_starts[t + 1]], in the directions in move_directions
+        floor_ids = np.full(self.width * self.height, -1, dtype=np.intp)
+        floor_ids[floor_indices] = np.arange(num_floor)
+        move_targets = floor_ids[self.neighbour_table[floor_indices]].ravel()
+        moves_by_target = np.argsort(move_targets, kind="stable")
+        move_sources = moves_by_target // num_directions
+        move_directions = moves_by_target % num_directions
+        move_starts = np.zeros(num_floor + 1, dtype=np.intp)
+        np.cumsum(np.bincount(move_targets, minlength=num_floor), out=move_starts[1:])
+
+        # The spaces of block b are members[block_starts[b]:block_ends[b]], and positions[s] is where space s is in
+        #   members. There can never be more blocks than floor spaces. The first blocks are the colors
+        block_of = np.unique(self.color_codes[floor_indices], return_inverse=True)[1].ravel().astype(np.intp)
+        num_blocks = int(block_of.max()) + 1
+        members = np.argsort(block_of, kind="stable")
+        positions = np.empty(num_floor, dtype=np.intp)
+        positions[members] = np.arange(num_floor)
+        block_sizes = np.zeros(num_floor, dtype=np.intp)
+        block_sizes[:num_blocks] = np.bincount(block_of)
+        block_ends = np.cumsum(block_sizes)
+        block_starts = block_ends - block_sizes
+        # Scratch space for each round, which only touches the entries of the spaces and blocks it splits
+        is_moving = np.zeros(num_floor, dtype=bool)
+        block_tail_starts = np.zeros(num_floor, dtype=np.intp)
+
+        # Every space moves into the floor the same way, so every color but the biggest one is a splitter
+        splitters = np.delete(np.arange(num_blocks), np.argmax(block_sizes[:num_blocks]))
+        while len(splitters) > 0:
+            # Every move into the spaces of the splitters
+            targets = members[_ranges(block_starts[splitters], block_ends[splitters])]
+            moves = _ranges(move_starts[targets], move_starts[targets + 1])
+            sources = move_sources[moves]
+            target_blocks = np.repeat(block_of[targets], move_starts[targets + 1] - move_starts[targets])
+            if directional:
+                # Which of the 4 directions go into the splitter, as bits
+                weights = 1 << move_directions[moves]
+            else:
+                # How many of the 4 moves go into the splitter
+                weights = np.ones(len(moves), dtype=np.intp)
+
+            # The signature of a space is its block, then the splitters it moves into with the weight of each (at
+            #   most 4 of them, padded out with -1)
+            pairs, pair_ids = np.unique(sources * num_floor + target_blocks, return_inverse=True)
+            pair_weights = np.bincount(pair_ids.ravel(), weights=weights).astype(np.intp)
+            affected, first_pairs, pair_counts = np.unique(pairs // num_floor, return_index=True,
+                                                           return_counts=True)
+            signatures = np.full((len(affected), num_directions + 1), -1, dtype=np.intp)
+            signatures[:, 0] = block_of[affected]
+            signatures[np.repeat(np.arange(len(affected)), pair_counts),
+                       np.arange(len(pairs)) - np.repeat(first_pairs, pair_counts) + 1] = \
+                (pairs % num_floor) * (1 << num_directions) + pair_weights
+
+            # The affected spaces of a block with the same signature make up a piece of it (a group). The unaffected
+            #   spaces of the block, which move into no splitter at all, make up one more piece. The groups are sorted
+            #   by block, so the groups of each block are next to each other
+            group_signatures, group_of, group_sizes = np.unique(signatures, axis=0, return_inverse=True,
+                                                                return_counts=True)
+            group_of = group_of.ravel()
+            blocks, first_groups, groups_per_block = np.unique(group_signatures[:, 0], return_index=True,
+                                                               return_counts=True)
+            affected_sizes = np.add.reduceat(group_sizes, first_groups)
+            rest_sizes = block_sizes[blocks] - affected_sizes
+            splitting = (groups_per_block > 1) | (rest_sizes > 0)
+            if not splitting.any():
+                break
+            splitting_groups = np.repeat(splitting, groups_per_block)
+            blocks = blocks[splitting]
+            groups_per_block = groups_per_block[splitting]
+            affected_sizes = affected_sizes[splitting]
+            rest_sizes = rest_sizes[splitting]
+            group_sizes = group_sizes[splitting_groups]
+            group_parents = np.repeat(blocks, groups_per_block)
+
+            # The unaffected spaces keep the block's number (or the first group does, if there are none), and every
+            #   other group gets a new one
+            group_numbers = np.full(len(group_sizes), -1, dtype=np.intp)
+            keeps_number = np.zeros(len(group_sizes), dtype=bool)
+            keeps_number[np.cumsum(groups_per_block) - groups_per_block] = rest_sizes == 0
+            group_numbers[keeps_number] = group_parents[keeps_number]
+            group_numbers[~keeps_number] = num_blocks + np.arange(np.count_nonzero(~keeps_number))
+            num_blocks += np.count_nonzero(~keeps_number)
+
+            # Move the affected spaces to the end of their block's part of members, group by group. The unaffected
+            #   spaces that were there go into the places they leave
+            renumbered = np.full(len(splitting_groups), -1, dtype=np.intp)
+            renumbered[splitting_groups] = np.arange(len(group_sizes))
+            moving = splitting_groups[group_of]
+            moving_groups = renumbered[group_of[moving]]
+            by_group = np.argsort(moving_groups, kind="stable")
+            moving_spaces = affected[moving][by_group]
+            moving_groups = moving_groups[by_group]
+
+            tail_starts = block_ends[blocks] - affected_sizes
+            tail = _ranges(tail_starts, block_ends[blocks])
+            is_moving[moving_spaces] = True
+            block_tail_starts[blocks] = tail_starts
+            vacated = positions[moving_spaces]
+            vacated = np.sort(vacated[vacated < block_tail_starts[block_of[moving_spaces]]])
+            displaced = np.sort(tail[~is_moving[members[tail]]])
+            members[vacated] = members[displaced]
+            positions[members[vacated]] = vacated
+            members[tail] = moving_spaces
+            positions[moving_spaces] = tail
+            is_moving[moving_spaces] = False
+
+            # Where each group ends up in members
+            group_offsets = np.cumsum(group_sizes) - group_sizes
+            group_starts = np.repeat(tail_starts, groups_per_block) + group_offsets - \
+                np.repeat(group_offsets[np.cumsum(groups_per_block) - groups_per_block], groups_per_block)
+            block_ends[blocks] = tail_starts
+            block_starts[group_numbers] = group_starts
+            block_ends[group_numbers] = group_starts + group_sizes
+            block_of[moving_spaces] = group_numbers[moving_groups]
+            block_sizes[blocks] = rest_sizes
+            block_sizes[group_numbers] = group_sizes
+
+            # Every piece of a split block but the biggest is a splitter in the next round
+            has_rest = rest_sizes > 0
+            pieces = np.concatenate((group_numbers, blocks[has_rest]))
+            piece_parents = np.concatenate((group_parents, blocks[has_rest]))
+            order = np.lexsort((-block_sizes[pieces], piece_parents))
+            pieces = pieces[order]
+            biggest = np.ones(len(pieces), dtype=bool)
+            biggest[1:] = piece_parents[order][1:] != piece_parents[order][:-1]
+            splitters = pieces[~biggest]
+
+        # Number the blocks by their first space
+        first_spaces = np.full(num_blocks, num_floor)
+        np.minimum.at(first_spaces, block_of, np.arange(num_floor))
+        block_order = np.empty(num_blocks, dtype=np.intp)
+        block_order[np.argsort(first_spaces, kind="stable")] = np.arange(num_blocks)
+        labels[floor_indices] = block_order[block_of]
+        return labels, num_blocks
 
     # Renders the robot locations onto the maze
     def create_render_list(self):
@@ -123,7 +534,7 @@ class ColoredMaze:
             return actual_color
 
         # The sensor works as intended 88% of the time
-        if random.random() <= 0.88:
+        if random.random() <= self.SENSOR_ACCURACY:
             return actual_color
 
         # Return a random color from the list that is not the actual color
@@ -135,33 +546,23 @@ class ColoredMaze:
     # This also considers running into a wall and staying in the same space
     # If the robot has more than one move that hits a wall, the original location
     #   will appear more than once in the possible_locations returned
+    # The moves are tried in the order West, South, North, East
     def blind_movements_indices(self, index):
-        possible_locations = []
-        x = index % self.width
-        y = self.height - index // self.width - 1
-        for x_mov in range(-1, 2):
-            for y_mov in range(-1, 2):
-                if abs(x_mov) + abs(y_mov) > 1 or (x_mov == 0 and y_mov == 0):
-                    continue
-                if self.is_floor_xy(x + x_mov, y + y_mov):
-                    possible_locations.append(self.index(x + x_mov, y + y_mov))
-                else:
-                    possible_locations.append(index)
+        return self.neighbour_table[index, _BLIND_MOVE_COLUMNS].tolist()
 
-        return possible_locations
+    # Returns a (w * h, 4) numpy array where row i is blind_movements_indices(i), for every index in the maze
+    # This is the at-most-4-neighbours structure of the random movement matrix without the matrix itself
+    # The columns are in the same order that blind_movements_indices tries the moves in: West, South, North, East
+    def get_blind_movements_table(self):
+        return self.neighbour_table[:, _BLIND_MOVE_COLUMNS].astype(np.intp)
 
-    # Using the 0.88 for the sensor accuracy
+    # Using the 0.88 (SENSOR_ACCURACY) for the sensor accuracy
+    # Walls have a 0, since the robot can never be on them
     def get_color_vector(self, color):
         vector = np.zeros(self.width * self.height)
-        for x in range(self.width):
-            for y in range(self.height):
-                tile_color = self.get_color(x, y)
-                if tile_color == color:
-                    vector[self.index(x, y)] = 0.88
-                elif tile_color:
-                    vector[self.index(x, y)] = 0.04
-                # else:
-                #     vector[self.index(x, y)] = 0.00001
+        vector[self.floor_mask] = self.SENSOR_ERROR
+        if color in self.COLORS:
+            vector[self.color_codes == self.COLORS.index(color)] = self.SENSOR_ACCURACY
 
         return vector
 
@@ -169,9 +570,23 @@ class ColoredMaze:
     #   be if we moved in that direction. Rows represent the start index, columns represent the end index
     def get_direction_matrix(self, direction):
         direction_matrix = np.zeros((self.width * self.height, self.width * self.height))
+        direction_matrix[np.arange(self.width * self.height), self.get_direction_targets(direction)] = 1
+
+        return direction_matrix
+
+    # Every row of a direction matrix has exactly one 1 in it, so the whole matrix can be stored as an integer array
+    #   where targets[start index] = end index
+    # Any other direction stays still everywhere
+    def get_direction_targets(self, direction):
+        if direction not in self.DIRECTIONS:
+            return np.arange(self.width * self.height, dtype=np.intp)
+        return self.neighbour_table[:, self.DIRECTIONS.index(direction)].astype(np.intp)
+
+    @staticmethod
+    # Returns the (x, y) offset of moving one space in the given direction in {'N', 'E', 'S', 'W'}
+    def _direction_offset(direction):
         x_mov = 0
         y_mov = 0
-        # Handle which direction we are looking at
         if direction == "N":
             y_mov = 1
         elif direction == "E":
@@ -180,17 +595,7 @@ class ColoredMaze:
             y_mov = -1
         elif direction == "W":
             x_mov = -1
-
-        for x in range(self.width):
-            for y in range(self.height):
-                # We can move in this direction from this space
-                if self.is_floor_xy(x + x_mov, y + y_mov):
-                    direction_matrix[self.index(x, y)][self.index(x + x_mov, y + y_mov)] = 1
-                # We hit a wall or the edge and stay still
-                else:
-                    direction_matrix[self.index(x, y)][self.index(x, y)] = 1
-
-        return direction_matrix
+        return x_mov, y_mov
 
     @staticmethod
     # Returns the character of a given robot number
@@ -202,11 +607,12 @@ class ColoredMaze:
         num_length = 5
         string = "| "
         curr_col = 0
+        maze_map = self.maze_map
         for i in range(len(probability_state)):
             if curr_col == self.width:
                 curr_col = 0
                 string += "\n| "
-            cell_info = self.maze_map[i] + ": "
+            cell_info = maze_map[i] + ": "
             if probability_state[i] < 10 ** -(num_length - 1):
                 if probability_state[i] > 5 * 10 ** -num_length:
                     cell_info += "0.0001"
@@ -243,16 +649,30 @@ class ColoredMaze:
     # If there are other robots, they will be removed
     def randomize_robot_location(self):
         # Put the robot on some random empty floor space
-        floor_loc = []
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.is_floor_xy(x, y):
-                    floor_loc.append((x, y))
-        robot_loc = random.choice(floor_loc)
+        # Indexed by [x, y], and listed going through x and then y
+        floor_x, floor_y = np.nonzero(self.get_floor_grid()[::-1].T)
+        choice = random.choice(range(len(floor_x)))
         # Set the robot locations to their appropriate values in the colored maze
         self.robot_loc = []
-        self.robot_loc.append(robot_loc[0])
-        self.robot_loc.append(robot_loc[1])
+        self.robot_loc.append(int(floor_x[choice]))
+        self.robot_loc.append(int(floor_y[choice]))
+
+
+# The character of every space code, and a lookup table from a byte of a maze file to its space code (255 if invalid)
+_SPACE_CHARS = "".join(ColoredMaze.COLORS) + ColoredMaze.WALL
+_SPACE_CHAR_ARRAY = np.array(list(_SPACE_CHARS))
+_INVALID_SPACE = 255
+_SPACE_CODES = np.full(256, _INVALID_SPACE, dtype=np.uint8)
+for _i, _char in enumerate(_SPACE_CHARS):
+    _SPACE_CODES[ord(_char)] = _i
+# The columns of the neighbour table in the order blind_movements_indices tries the moves: West, South, North, East
+# The concatenation of range(starts[i], ends[i]) for every i, as one array
+def _ranges(starts, ends):
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(np.sum(lengths))
+
+
+_BLIND_MOVE_COLUMNS = [ColoredMaze.DIRECTIONS.index(direction) for direction in ["W", "S", "N", "E"]]
 
 if __name__ == "__main__":
     maze1 = ColoredMaze("./mazes/maze1")
@@ -0,0 +1,183 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ColoredMaze import ColoredMaze
+from FloorFilteringMazePredictor import FloorFilteringMazePredictor
+
+
+# One connected component of the maze's floor and the filter that runs on it
+class _Component:
+    __slots__ = ("floor_indices", "sub_floor", "predictor", "log_prior", "state", "log_evidence", "active")
+
+    def __init__(self, floor_indices, sub_floor, predictor, log_prior):
+        # The maze indices of the component's spaces, in the same order as the floor spaces of its own maze
+        self.floor_indices = floor_indices
+        self.sub_floor = sub_floor
+        self.predictor = predictor
+        self.log_prior = log_prior
+        self.state = None
+        self.log_evidence = 0.0
+        self.active = True
+
+
+# Filters a maze whose floor is split into regions the robot can never move between (like
+#   mazes/disconnectedComponents) as one small filter per region instead of one big one.
+# No probability ever moves between components, so the movement matrix of the whole maze is block diagonal, with a
+#   block per component. Each component gets its own predictor on a maze cut down to the component's bounding box,
+#   with everything outside the component turned into walls, and keeps a belief over its own spaces along with the
+#   evidence for it: log P(readings | the robot started somewhere in the component). The belief over the whole maze
+#   is each component's belief weighted by its posterior probability, P(component | readings), which comes from the
+#   evidence and the fraction of the floor in the component.
+# Components whose posterior probability drops below `tolerance` are retired: they are no longer updated and their
+#   probability is set to 0. The remaining components can be updated on `num_workers` threads (numpy releases the
+#   GIL during its matrix products, so larger components do run at the same time).
+class ComponentFilter:
+    def __init__(self, colored_maze, backend="dense", predictor_class=FloorFilteringMazePredictor, tolerance=1e-12,
+                 num_workers=1):
+        self.colored_maze = colored_maze
+        self.tolerance = tolerance
+        self.executor = ThreadPoolExecutor(num_workers) if num_workers > 1 else None
+
+        labels, self.num_components = colored_maze.get_connected_components()
+        floor_indices = np.flatnonzero(labels >= 0)
+        # The floor spaces of every component, each in maze order
+        component_sizes = np.bincount(labels[floor_indices], minlength=self.num_components)
+        grouped_indices = np.split(floor_indices[np.argsort(labels[floor_indices], kind="stable")],
+                                   np.cumsum(component_sizes)[:-1])
+
+        codes_grid = np.reshape(colored_maze.color_codes, (colored_maze.height, colored_maze.width))
+        labels_grid = np.reshape(labels, (colored_maze.height, colored_maze.width))
+        self.components = []
+        for label, component_indices in enumerate(grouped_indices):
+            rows = component_indices // colored_maze.width
+            columns = component_indices % colored_maze.width
+            box = (slice(rows.min(), rows.max() + 1), slice(columns.min(), columns.max() + 1))
+
+            sub_floor = labels_grid[box] == label
+            sub_codes = np.where(sub_floor, codes_grid[box], ColoredMaze.WALL_CODE).astype(np.uint8)
+            sub_maze = ColoredMaze.from_codes(sub_codes.ravel(), sub_codes.shape[1], sub_codes.shape[0])
+
+            # The robot starts anywhere on the floor with equal probability
+            log_prior = np.log(len(component_indices) / len(floor_indices))
+            self.components.append(_Component(component_indices, sub_floor.ravel(),
+                                              predictor_class(sub_maze, backend), log_prior))
+
+        self.reset()
+
+    # Go back to the start: every component is active, with a uniform belief over its spaces and no evidence yet
+    def reset(self):
+        for component in self.components:
+            state = component.predictor.from_grid_state(component.sub_floor.astype(float))
+            component.state = state / np.sum(state)
+            component.log_evidence = 0.0
+            component.active = True
+
+    # Take one new sensor reading (and optionally the move that was attempted before it) into account
+    def update(self, sensor_data, move=None):
+        predictor = self.components[0].predictor
+        reading_codes, move_codes = predictor.encode_sequence([sensor_data], None if move is None else [move])
+        self._advance(reading_codes, move_codes)
+
+    # Same as the predictor's solve_for_probability_distribution, starting from the beginning
+    # Components are checked for retirement every chunk_size steps
+    def solve_for_probability_distribution(self, sensor_readings, movements=None, chunk_size=64):
+        encoded = self.components[0].predictor.encode_sequence(sensor_readings, movements)
+        if encoded is None:
+            return None
+        reading_codes, move_codes = encoded
+
+        self.reset()
+        for start in range(0, len(reading_codes), chunk_size):
+            self._advance(reading_codes[start:start + chunk_size], move_codes[start:start + chunk_size])
+
+        if not any(component.active for component in self.components):
+            return None
+        return self.belief()
+
+    # Returns the probability distribution over the whole maze, in the layout of the maze map
+    def belief(self):
+        belief = np.zeros(self.colored_maze.width * self.colored_maze.height)
+        for component, probability in zip(self.components, self.component_probabilities()):
+            if component.active:
+                component_belief = component.predictor.to_grid_state(component.state)[component.sub_floor]
+                belief[component.floor_indices] = component_belief * (probability / np.sum(component_belief))
+        return belief
+
+    # Returns P(component | readings) for every component, which is 0 for retired components
+    def component_probabilities(self):
+        log_posteriors = np.array([component.log_prior + component.log_evidence if component.active else -np.inf
+                                   for component in self.components])
+        largest = np.max(log_posteriors)
+        if not np.isfinite(largest):
+            return np.zeros(self.num_components)
+        posteriors = np.exp(log_posteriors - largest)
+        return posteriors / np.sum(posteriors)
+
+    # Returns log P(readings | the robot started in the component) for every component. Retired components keep
+    #   their evidence from when they were retired, and components that could not have produced the readings have
+    #   -inf
+    def component_log_evidence(self):
+        return np.array([component.log_evidence for component in self.components])
+
+    # The number of components that are still being updated
+    def num_active(self):
+        return sum(component.active for component in self.components)
+
+    # Stop the worker threads
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Run the encoded steps on every active component, and then retire the ones that have become too unlikely
+    def _advance(self, reading_codes, move_codes):
+        active = [component for component in self.components if component.active]
+        if self.executor is not None:
+            list(self.executor.map(lambda component: self._run(component, reading_codes, move_codes), active))
+        else:
+            for component in active:
+                self._run(component, reading_codes, move_codes)
+
+        probabilities = self.component_probabilities()
+        if not probabilities.any():
+            print("Sensor readings are impossible from every component", file=sys.stderr)
+        for component, probability in zip(self.components, probabilities):
+            if component.active and probability < self.tolerance:
+                component.active = False
+                component.state = None
+
+    @staticmethod
+    # Advance one component's belief and evidence through the encoded steps
+    def _run(component, reading_codes, move_codes):
+        predictor = component.predictor
+        state = component.state
+        log_evidence = component.log_evidence
+        for color_code, move_code in zip(reading_codes.tolist(), move_codes.tolist()):
+            state, total = predictor.get_next_state_scaled(state, color_code, move_code)
+            if total == 0:
+                # The component could not have produced this reading
+                component.log_evidence = -np.inf
+                component.active = False
+                component.state = None
+                return
+            log_evidence += np.log(total)
+
+        component.state = state
+        component.log_evidence = log_evidence
+
+
+if __name__ == "__main__":
+    component_filter = ComponentFilter(ColoredMaze("./mazes/disconnectedComponents"))
+    readings = ["g", "g", "g", "y", "g", "g"]
+    component_filter.colored_maze.illustrate_probabilities(
+        component_filter.solve_for_probability_distribution(readings))
+    print(f"Component probabilities: {np.round(component_filter.component_probabilities(), 4)}")
+    print(f"Component log evidence: {np.round(component_filter.component_log_evidence(), 4)}")
@@ -1,8 +1,15 @@
+import math
 import sys
 
 from ColoredMaze import ColoredMaze
 import numpy as np
 
+# scipy is only needed for the sparse backend
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
 # Author: Ben Williams '25
 # Date: October 30th, 2023
 
@@ -13,89 +20,566 @@ import numpy as np
 #   The robot is blind, if it tries to move North and hits a wall, it doesn't know that it failed.
 #   The robot has a mostly-working color sensor. If it is over the color blue, the sensor will report "b"
 #       88% of the time, red 4% of the time, green 4% of the time, and yellow 4% of the time
+# Backends:
+#   "dense": the movement and direction matrices are full (w * h, w * h) numpy arrays
+#   "sparse": the movement and direction matrices are scipy CSR matrices, which only store the (at most 4)
+#       nonzero entries of each row. Memory is O(w * h) and each prediction step is O(nonzeros)
+#   "stencil": no transition matrices at all. The belief is reshaped to the (h, w) grid and the prediction step is
+#       done with shifted copies of the grid and precomputed wall masks. Time and memory are O(w * h)
 class FilteringMazePredictor:
-    def __init__(self, colored_maze):
+    BACKENDS = ("dense", "sparse", "stencil")
+    COLORS = ColoredMaze.COLORS
+    DIRECTIONS = ("N", "E", "S", "W")
+    # In encoded move arrays, the moves in DIRECTIONS are 0-3 and a move we do not know is RANDOM_MOVE
+    RANDOM_MOVE = len(DIRECTIONS)
+    # In encoded reading arrays, the colors in COLORS are 0-3 and a step without a reading (the sensor was off) is
+    #   NO_READING. Its row of the likelihood table is 1 on every floor space, so the step is just a prediction
+    NO_READING = len(COLORS)
+    # How many steps without readings predict_unobserved takes before it first checks whether it has converged. The
+    #   checks after that get twice as far apart each time
+    STATIONARY_CHECK_STEPS = 64
+    # How much of the state predict_unobserved can lose by cutting off its Chebyshev expansions
+    CHEBYSHEV_TOLERANCE = 1e-13
+
+    # For each direction, the np.roll (shift, axis) that lines up every space with its neighbour in that direction
+    #   on the (h, w) grid. Row 0 is the top of the maze, so North is the row above
+    STENCIL_SHIFTS = {"N": (1, 0), "E": (-1, 1), "S": (-1, 0), "W": (1, 1)}
+
+    # The names of the model arrays each backend needs, on top of the initial state, color likelihoods and direction
+    #   targets that every backend uses
+    MODEL_ARRAY_NAMES = {
+        "dense": ("movement_matrix",),
+        "sparse": ("movement_data", "movement_indices", "movement_indptr"),
+        "stencil": ("floor_grid", "open_direction_grids"),
+    }
+    COMMON_MODEL_ARRAY_NAMES = ("initial_state", "likelihood_table", "direction_target_table")
+
+    # Nothing is built here. Every part of the model (the initial state, the movement matrix, the color vectors, the
+    #   direction targets...) is built the first time it is used, so a session that only uses random moves never
+    #   builds the direction targets, and one that knows its moves never builds the movement matrix
+    # Call warm() to build everything up front instead
+    def __init__(self, colored_maze, backend="dense"):
+        self._check_backend(backend)
         self.colored_maze = colored_maze
+        self.backend = backend
+        self._set_model_arrays(dict())
+
+    # Make a predictor from arrays returned by build_model_arrays (or model_arrays of another predictor on the same
+    #   maze and backend) without building anything again. The arrays are used as they are, not copied, so they can
+    #   be read-only views of shared or memory-mapped memory. Any missing arrays are built when first used
+    @classmethod
+    def from_model_arrays(cls, colored_maze, model_arrays, backend="dense"):
+        cls._check_backend(backend)
+        predictor = cls.__new__(cls)
+        predictor.colored_maze = colored_maze
+        predictor.backend = backend
+        predictor._set_model_arrays(dict(model_arrays))
+        return predictor
+
+    @classmethod
+    def _check_backend(cls, backend):
+        if backend not in cls.BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, expected one of {cls.BACKENDS}")
+        if backend == "sparse" and scipy is None:
+            raise ImportError("scipy is required for the sparse backend")
 
+    # Build every part of the model now rather than when it is first used, for callers that care about the latency
+    #   of their first step. Returns the predictor
+    def warm(self):
+        for name in self.COMMON_MODEL_ARRAY_NAMES + self.MODEL_ARRAY_NAMES[self.backend]:
+            self._get_model_array(name)
+        return self
+
+    # Builds everything the filter needs for this maze and backend as a dict of numpy arrays
+    def build_model_arrays(self):
+        return dict(self.warm().model_arrays)
+
+    # Builds one model array (the sparse movement matrix is built as its three CSR arrays at once)
+    def _build_model_array(self, name):
         # Get the initial state of possibilities represented as a 1D array
-        self.initial_state = self.get_initial_state()
-        self.movement_matrix = self.random_movement_matrix()
+        if name == "initial_state":
+            return {name: self.get_initial_state()}
+
+        # Assume we moved in a random direction
+        if name == "movement_matrix":
+            return {name: self.random_movement_matrix()}
+        if name in ("movement_data", "movement_indices", "movement_indptr"):
+            movement_matrix = self.sparse_random_movement_matrix()
+            return {"movement_data": movement_matrix.data, "movement_indices": movement_matrix.indices,
+                    "movement_indptr": movement_matrix.indptr}
 
         # Get the vectors for how likely it is that we see a color at a given space
-        self.color_vectors = dict()
-        self.color_vectors["r"] = self.colored_maze.get_color_vector("r")
-        self.color_vectors["g"] = self.colored_maze.get_color_vector("g")
-        self.color_vectors["b"] = self.colored_maze.get_color_vector("b")
-        self.color_vectors["y"] = self.colored_maze.get_color_vector("y")
-
-        # Get the direction matrices for each possible direction. Allows us to consider where the robot is moving
-        #   (if we want)
-        self.direction_matrices = dict()
-        self.direction_matrices["N"] = self.colored_maze.get_direction_matrix("N")
-        self.direction_matrices["E"] = self.colored_maze.get_direction_matrix("E")
-        self.direction_matrices["S"] = self.colored_maze.get_direction_matrix("S")
-        self.direction_matrices["W"] = self.colored_maze.get_direction_matrix("W")
+        # They are stacked into a (colors + 1, w * h) table so that encoded readings can index it directly, with the
+        #   floor mask as the last row for steps without a reading
+        if name == "likelihood_table":
+            return {name: np.stack([self.colored_maze.get_color_vector(color) for color in self.COLORS]
+                                   + [self.colored_maze.floor_mask.astype(float)])}
+
+        # The direction matrices only have a single 1 in each row, so when we know the move the prediction step
+        #   just gathers each space's probability from the index it would move to. Used by every backend. Allows us
+        #   to consider where the robot is moving (if we want)
+        if name == "direction_target_table":
+            return {name: np.stack([self.colored_maze.get_direction_targets(direction)
+                                    for direction in self.DIRECTIONS])}
+
+        # The stencil backend replaces the random movement matrix with masks of the floor spaces and of which
+        #   spaces can move in each direction without hitting a wall
+        if name == "floor_grid":
+            return {name: self.colored_maze.get_floor_grid()}
+        if name == "open_direction_grids":
+            return {name: np.stack([self.colored_maze.get_open_direction_grid(direction)
+                                    for direction in self.DIRECTIONS])}
+
+        raise KeyError(f"Unknown model array {name}")
+
+    # Returns the model array with the given name, building it first if it has not been built yet
+    def _get_model_array(self, name):
+        if name not in self.model_arrays:
+            self.model_arrays.update(self._build_model_array(name))
+        return self.model_arrays[name]
+
+    # Use the given (possibly partial) model arrays, and forget anything made from the previous ones
+    def _set_model_arrays(self, model_arrays):
+        self.model_arrays = model_arrays
+        self._movement_matrix = None
+        self._color_vectors = None
+        self._direction_targets = None
+        self._direction_matrices = None
+        self._open_direction_grids = None
+        self._components = None
+
+    # The length of the belief vectors: one entry for every space in the maze
+    @property
+    def num_states(self):
+        return self.colored_maze.width * self.colored_maze.height
+
+    # Returns a belief in the layout of the maze map (one entry per space), e.g. for illustrate_probabilities
+    # The beliefs of this predictor already have that layout
+    def to_grid_state(self, state):
+        return state
+
+    # Returns a belief in the layout of this predictor's states from one in the layout of the maze map
+    def from_grid_state(self, grid_state):
+        return np.asarray(grid_state)
+
+    @property
+    def initial_state(self):
+        return self._get_model_array("initial_state")
+
+    # The stencil backend has no matrices at all, so asking it for one is an error
+    @property
+    def movement_matrix(self):
+        if self.backend == "stencil":
+            raise ValueError("The stencil backend has no movement matrix, use the dense or sparse backend "
+                             "(or random_movement_matrix)")
+        if self._movement_matrix is None:
+            if self.backend == "sparse":
+                num_locations = self.num_states
+                self._movement_matrix = scipy.sparse.csr_matrix(
+                    (self._get_model_array("movement_data"), self._get_model_array("movement_indices"),
+                     self._get_model_array("movement_indptr")),
+                    shape=(num_locations, num_locations), copy=False)
+            else:
+                self._movement_matrix = self._get_model_array("movement_matrix")
+        return self._movement_matrix
+
+    # The color vectors are views of the rows of the likelihood table
+    @property
+    def likelihood_table(self):
+        return self._get_model_array("likelihood_table")
+
+    @property
+    def color_vectors(self):
+        if self._color_vectors is None:
+            self._color_vectors = dict()
+            for i, color in enumerate(self.COLORS):
+                self._color_vectors[color] = self.likelihood_table[i]
+        return self._color_vectors
+
+    # The direction targets are views of the rows of the direction target table
+    @property
+    def direction_target_table(self):
+        return self._get_model_array("direction_target_table")
+
+    @property
+    def direction_targets(self):
+        if self._direction_targets is None:
+            self._direction_targets = dict()
+            for i, direction in enumerate(self.DIRECTIONS):
+                self._direction_targets[direction] = self.direction_target_table[i]
+        return self._direction_targets
+
+    # The direction matrices are only kept for callers that want them as matrices. Nothing in the filter uses them
+    #   (known moves gather through the direction targets), so they are not model arrays: they are built from the
+    #   direction targets on first access, and never by warm() or build_model_arrays()
+    @property
+    def direction_matrices(self):
+        if self.backend == "stencil":
+            raise ValueError("The stencil backend has no direction matrices, use the dense or sparse backend "
+                             "(or direction_targets)")
+        if self._direction_matrices is None:
+            self._direction_matrices = dict()
+            num_locations = self.num_states
+            for i, direction in enumerate(self.DIRECTIONS):
+                if self.backend == "sparse":
+                    # A CSR matrix with exactly one entry per row, in the column given by the targets
+                    self._direction_matrices[direction] = scipy.sparse.csr_matrix(
+                        (np.ones(num_locations), self.direction_target_table[i], np.arange(num_locations + 1)),
+                        shape=(num_locations, num_locations), copy=False)
+                else:
+                    direction_matrix = np.zeros((num_locations, num_locations))
+                    direction_matrix[np.arange(num_locations), self.direction_target_table[i]] = 1
+                    self._direction_matrices[direction] = direction_matrix
+        return self._direction_matrices
+
+    @property
+    def floor_grid(self):
+        if self.backend != "stencil":
+            return None
+        return self._get_model_array("floor_grid")
+
+    @property
+    def open_direction_grids(self):
+        if self._open_direction_grids is None:
+            self._open_direction_grids = dict()
+            if self.backend == "stencil":
+                for i, direction in enumerate(self.DIRECTIONS):
+                    self._open_direction_grids[direction] = self._get_model_array("open_direction_grids")[i]
+        return self._open_direction_grids
 
     # We assume that we can be in any floor location of the maze with equal probability
+    # Walls get a hundredth of the probability of a floor space
     def get_initial_state(self):
-        total_valid_locations = 0
-        # Initialize the list with floats
-        initial_state = [0.0 for _ in range(self.colored_maze.width * self.colored_maze.height)]
-        for i in range(len(initial_state)):
-            if self.colored_maze.is_floor_index(i):
-                # We mark that this is a floor space
-                initial_state[i] = 1.0
-                total_valid_locations += 1
+        floor = self.colored_maze.get_floor_grid().ravel()
+        total_valid_locations = np.count_nonzero(floor)
 
         # Set the probabilities of all floor spaces to be equal (and add up to one)
-        for i in range(self.colored_maze.width * self.colored_maze.height):
-            # This is a valid (non-wall) spot on the maze
-            if initial_state[i] == 1:
-                initial_state[i] = 1 / total_valid_locations
-            else:
-                initial_state[i] = (1 / total_valid_locations) / 100
-
-        return np.array(initial_state)
+        return np.where(floor, 1 / total_valid_locations, (1 / total_valid_locations) / 100)
 
     # Given an array of sensor readings, return the probability distribution of where we are across the maze
-    # Parameter: A list of chars in {'r', 'g', 'b', 'y'} as sensor readings
+    # Parameter: A list of chars in {'r', 'g', 'b', 'y'} as sensor readings, or None for steps without a reading
     # Optional Parameter: A list of moves as {'N', 'E', 'S', 'W'} as the moves the robot has taken
     # The lengths of both lists must be the same is movements are provided
+    # Stretches of random moves without readings are skipped with predict_unobserved
     def solve_for_probability_distribution(self, sensor_readings, movements=None):
         if movements:
             if len(sensor_readings) != len(movements):
                 print("Movements and sensor readings must be the same length", file=sys.stderr)
                 return None
         current_state = self.initial_state
-        for i in range(len(sensor_readings)):
+        i = 0
+        while i < len(sensor_readings):
+            if sensor_readings[i] is None and not (movements and movements[i]):
+                run_end = i + 1
+                while run_end < len(sensor_readings) and sensor_readings[run_end] is None and \
+                        not (movements and movements[run_end]):
+                    run_end += 1
+                current_state = self.predict_unobserved(current_state, run_end - i)
+                i = run_end
+                continue
+
             if movements:
                 current_state = self.get_next_state(current_state, sensor_readings[i], movements[i])
             else:
                 current_state = self.get_next_state(current_state, sensor_readings[i])
+            i += 1
+
+        return current_state
+
+    # Takes num_steps random moves without any sensor readings. Without readings a step is just the random movement
+    #   matrix M, which keeps all of the probability on the floor, so k steps are M^k @ state with nothing to
+    #   multiply or renormalize in between (see predict_power for how that takes about sqrt(k) steps)
+    # With no readings the probability also spreads out within each connected component of the maze until it is even
+    #   over the component's spaces (see stationary_state). The steps are taken in chunks that start at
+    #   STATIONARY_CHECK_STEPS and double in size, and once the state is within stationary_tolerance of that (in
+    #   total variation) the rest of the steps are skipped. A long dropout costs at most the time it takes to mix
+    def predict_unobserved(self, prev_state, num_steps, stationary_tolerance=1e-9):
+        # Walls lose their probability on the first step anyway
+        current_state = prev_state * self.likelihood_table[self.NO_READING]
+        current_state *= 1 / np.sum(current_state)
+
+        chunk_size = self.STATIONARY_CHECK_STEPS
+        while num_steps > 0:
+            chunk_steps = min(chunk_size, num_steps)
+            current_state = self.predict_power(current_state, chunk_steps)
+            num_steps -= chunk_steps
+            chunk_size *= 2
+            if num_steps > 0:
+                stationary_state = self.stationary_state(current_state)
+                if 0.5 * np.sum(np.abs(current_state - stationary_state)) <= stationary_tolerance:
+                    return stationary_state
 
         return current_state
 
+    # Returns M^num_steps @ state (renormalized) for a state with no probability on the walls, where M is the random
+    #   movement matrix
+    # M is symmetric with its eigenvalues in [-1, 1], so x^k can be swapped for its Chebyshev expansion: x^k is the
+    #   sum over d of P(|Y| = d) T_d(x), where Y is the sum of k random +-1s. The terms past
+    #   d = sqrt(2k log(2 / CHEBYSHEV_TOLERANCE)) add up to less than CHEBYSHEV_TOLERANCE, and T_d(M) @ state comes
+    #   from the recurrence T_d(M) = 2M T_(d - 1)(M) - T_(d - 2)(M), so this takes about sqrt(k) prediction steps
+    #   instead of k. Runs too short for that to help are stepped through one at a time
+    def predict_power(self, state, num_steps):
+        degree = math.ceil(math.sqrt(2 * num_steps * math.log(2 / self.CHEBYSHEV_TOLERANCE)))
+        if degree >= num_steps:
+            for _ in range(num_steps):
+                state = self.prediction_step(state)
+            return state / np.sum(state)
+
+        # P(|Y| = d) is 0 unless d has the same parity as k, and otherwise twice the chance of Y = d (once for d = 0)
+        coefficients = np.zeros(degree + 1)
+        for d in range(num_steps % 2, degree + 1, 2):
+            coefficients[d] = math.exp(math.lgamma(num_steps + 1) - math.lgamma((num_steps + d) // 2 + 1)
+                                       - math.lgamma((num_steps - d) // 2 + 1) - num_steps * math.log(2))
+        coefficients[1:] *= 2
+
+        previous = state
+        current = self.prediction_step(state)
+        result = coefficients[0] * previous + coefficients[1] * current
+        for d in range(2, degree + 1):
+            previous, current = current, 2 * self.prediction_step(current) - previous
+            if coefficients[d] > 0:
+                result += coefficients[d] * current
+
+        # Cutting off the expansion can leave entries just below 0
+        result = np.maximum(result, 0)
+        result *= 1 / np.sum(result)
+        return result
+
+    # The state that random moves without readings converge to from the given state: each connected component of
+    #   the maze keeps the total probability it has, spread evenly over its spaces. Walls get 0
+    # Every component has a space next to a wall or the edge, where the robot can stay still, so this is where the
+    #   random movement always ends up (the movement matrix is symmetric, and aperiodic on every component)
+    def stationary_state(self, state):
+        labels, sizes = self.components
+        floor = labels >= 0
+        totals = np.bincount(labels[floor], weights=state[floor], minlength=len(sizes))
+        stationary_state = np.zeros(len(state))
+        stationary_state[floor] = (totals / sizes)[labels[floor]]
+        return stationary_state
+
+    # The connected component of every state (-1 for walls) and the number of states in each component
+    @property
+    def components(self):
+        if self._components is None:
+            labels, num_components = self.colored_maze.get_connected_components()
+            labels = self.from_grid_state(labels)
+            self._components = (labels, np.bincount(labels[labels >= 0], minlength=num_components))
+        return self._components
+
+    # Turn sensor readings into a uint8 array of indices into COLORS. None (no reading) becomes NO_READING
+    # Accepts a list or string of chars in {'r', 'g', 'b', 'y'}, a bytes object of those chars (or of the indices
+    #   themselves), or any numpy array of chars or indices
+    @classmethod
+    def encode_readings(cls, sensor_readings):
+        # Same as encode_moves, the byte with value NO_READING already encodes to NO_READING
+        if isinstance(sensor_readings, list) and None in sensor_readings:
+            sensor_readings = [chr(cls.NO_READING) if reading is None else reading for reading in sensor_readings]
+        return _encode(sensor_readings, _COLOR_CODES, "sensor reading")
+
+    # Turn moves into a uint8 array of indices into DIRECTIONS. None (a move we do not know) becomes RANDOM_MOVE
+    @classmethod
+    def encode_moves(cls, movements):
+        # The byte with value RANDOM_MOVE already encodes to RANDOM_MOVE, so None can be swapped for it as a char
+        if isinstance(movements, list) and None in movements:
+            movements = [chr(cls.RANDOM_MOVE) if move is None else move for move in movements]
+        return _encode(movements, _DIRECTION_CODES, "move")
+
+    # The same as solve_for_probability_distribution, but on encoded readings and moves (see encode_readings and
+    #   encode_moves). Anything that is not already encoded gets encoded first
+    # Stretches of random moves without readings are skipped with predict_unobserved
+    def solve_encoded(self, reading_codes, move_codes=None):
+        encoded = self.encode_sequence(reading_codes, move_codes)
+        if encoded is None:
+            return None
+        reading_codes, move_codes = encoded
+        if len(reading_codes) == 0:
+            return self.initial_state
+
+        # Split the steps into stretches that are all unobserved random moves, and stretches with none of them
+        unobserved = (reading_codes == self.NO_READING) & (move_codes == self.RANDOM_MOVE)
+        boundaries = np.concatenate(([0], np.flatnonzero(np.diff(unobserved)) + 1, [len(unobserved)])).tolist()
+
+        current_state = self.initial_state
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            if unobserved[start]:
+                current_state = self.predict_unobserved(current_state, end - start)
+                continue
+            for color_code, move_code in zip(reading_codes[start:end].tolist(), move_codes[start:end].tolist()):
+                current_state = self.get_next_state_encoded(current_state, color_code, move_code)
+
+        return current_state
+
+    # The same as get_next_state, with the sensor reading and move given as indices into COLORS and DIRECTIONS
+    def get_next_state_encoded(self, prev_state, color_code, move_code=RANDOM_MOVE):
+        if move_code == self.RANDOM_MOVE:
+            next_state = self.prediction_step(prev_state)
+        else:
+            next_state = prev_state[self.direction_target_table[move_code]]
+
+        next_state *= self.likelihood_table[color_code]
+        next_state *= 1 / np.sum(next_state)
+        return next_state
+
+    # Numerically safe version of solve_encoded for very long sequences. Returns the final probability distribution
+    #   along with the log-likelihood of the whole sequence of readings, log P(readings | moves)
+    # Every step is scaled back to a probability distribution, so the state never underflows, and the log of each
+    #   step's scaling factor is added up (in chunks, to keep Python work per step to a minimum)
+    # If a reading is impossible from the current state (the sum is 0), the log-likelihood becomes -inf and the
+    #   filter restarts from the initial state with that reading instead of producing NaNs
+    def solve_with_log_likelihood(self, reading_codes, move_codes=None, chunk_size=4096):
+        encoded = self.encode_sequence(reading_codes, move_codes)
+        if encoded is None:
+            return None
+        reading_codes, move_codes = encoded
+
+        current_state = self.initial_state
+        # The initial state also has a bit of probability on the walls, so it does not add up to exactly 1. The first
+        #   step's sum is scaled by that, so it is taken out once there is a step (with no readings it is 0)
+        log_likelihood = -np.log(np.sum(current_state)) if len(reading_codes) > 0 else 0.0
+        scales = np.ones(min(chunk_size, len(reading_codes)))
+        with np.errstate(divide="ignore"):
+            for t, (color_code, move_code) in enumerate(zip(reading_codes.tolist(), move_codes.tolist())):
+                current_state, scales[t % chunk_size] = self.get_next_state_scaled(current_state, color_code,
+                                                                                     move_code)
+                if t % chunk_size == chunk_size - 1:
+                    log_likelihood += np.sum(np.log(scales))
+                    scales[:] = 1
+            log_likelihood += np.sum(np.log(scales))
+
+        return current_state, log_likelihood
+
+    # The same as get_next_state_encoded, but also returns the sum that the state was scaled by, which is
+    #   P(reading | previous readings). Returns a sum of 0 (and restarts from the initial state) if the reading
+    #   is impossible
+    def get_next_state_scaled(self, prev_state, color_code, move_code=RANDOM_MOVE):
+        if move_code == self.RANDOM_MOVE:
+            next_state = self.prediction_step(prev_state)
+        else:
+            next_state = prev_state[self.direction_target_table[move_code]]
+
+        next_state *= self.likelihood_table[color_code]
+        total = np.sum(next_state)
+        if not (0 < total < np.inf):
+            next_state = self.initial_state * self.likelihood_table[color_code]
+            next_state *= 1 / np.sum(next_state)
+            return next_state, 0.0
+
+        next_state *= 1 / total
+        return next_state, total
+
+    # Encodes a sequence of readings and (optional) moves for the encoded solvers. Missing moves become RANDOM_MOVE
+    # Returns None if the lengths do not match
+    def encode_sequence(self, sensor_readings, movements=None):
+        reading_codes = self.encode_readings(sensor_readings)
+        if movements is None:
+            move_codes = np.full(len(reading_codes), self.RANDOM_MOVE, dtype=np.uint8)
+        else:
+            move_codes = self.encode_moves(movements)
+            if len(reading_codes) != len(move_codes):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+        return reading_codes, move_codes
+
+    # Filter many independent sequences of sensor readings on this maze at the same time
+    # Parameter: A list of B sequences of chars in {'r', 'g', 'b', 'y'}, or a (B, T) array of them (or of their
+    #   encoded indices, see encode_readings)
+    # Optional Parameter: The moves for each sequence, in the same shape as the sensor readings (None for a move we do
+    #   not know)
+    # Optional Parameter: The length of each sequence, for when the readings are a padded (B, T) array. Sequences
+    #   given as a list can have different lengths without this
+    # Returns a (B, w * h) array where row b is the same as solve_for_probability_distribution on sequence b.
+    #   All B beliefs are advanced together, so every step is one matrix-matrix product instead of B matrix-vector ones
+    def solve_batch(self, sensor_readings, movements=None, lengths=None):
+        if lengths is None:
+            lengths = [len(readings) for readings in sensor_readings]
+        lengths = np.array(lengths, dtype=int)
+        num_sequences = len(sensor_readings)
+        num_steps = int(lengths.max()) if num_sequences > 0 else 0
+
+        if movements is not None:
+            if len(movements) != num_sequences or \
+                    any(len(movements[b]) < lengths[b] for b in range(num_sequences)):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+
+        # Turn the readings and moves into (B, T) arrays of indices. Without moves every move is RANDOM_MOVE. Steps
+        #   past the end of a sequence are padded and masked out below
+        color_codes = np.zeros((num_sequences, num_steps), dtype=np.uint8)
+        move_codes = np.full((num_sequences, num_steps), self.RANDOM_MOVE, dtype=np.uint8)
+        for b in range(num_sequences):
+            color_codes[b, :lengths[b]] = self.encode_readings(sensor_readings[b][:lengths[b]])
+            if movements is not None:
+                move_codes[b, :lengths[b]] = self.encode_moves(movements[b][:lengths[b]])
+
+        likelihoods = self.likelihood_table
+        targets = self.direction_target_table
+
+        current_states = np.tile(self.initial_state, (num_sequences, 1))
+        for t in range(num_steps):
+            # Sequences with a known move gather from its targets, and the rest (moves that are None) move randomly
+            known = move_codes[:, t] != self.RANDOM_MOVE
+            if known.all():
+                predicted_states = np.take_along_axis(current_states, targets[move_codes[:, t]], axis=1)
+            elif not known.any():
+                predicted_states = self.batch_prediction_step(current_states)
+            else:
+                predicted_states = np.empty(current_states.shape)
+                predicted_states[known] = np.take_along_axis(current_states[known], targets[move_codes[known, t]],
+                                                             axis=1)
+                predicted_states[~known] = self.batch_prediction_step(current_states[~known])
+
+            next_states = predicted_states * likelihoods[color_codes[:, t]]
+            next_states *= (1 / np.sum(next_states, axis=1))[:, np.newaxis]
+
+            # Sequences that have already ended keep their final state
+            finished = lengths <= t
+            if finished.any():
+                next_states[finished] = current_states[finished]
+            current_states = next_states
+
+        return current_states
+
+    # The random movement prediction step for a (B, w * h) array of states, one per row
+    def batch_prediction_step(self, prev_states):
+        if self.backend == "stencil":
+            grids = np.reshape(prev_states, (len(prev_states), self.colored_maze.height, self.colored_maze.width))
+            predicted = np.zeros(grids.shape)
+            for direction in self.DIRECTIONS:
+                shift, axis = self.STENCIL_SHIFTS[direction]
+                predicted += np.where(self.open_direction_grids[direction], np.roll(grids, shift, axis=axis + 1),
+                                      grids)
+            return np.reshape(0.25 * predicted * self.floor_grid, (len(prev_states), -1))
+
+        # (M @ S^T)^T, written so that it also works with the scipy sparse movement matrix
+        return np.asarray(self.movement_matrix @ prev_states.T).T
+
     # Assuming the robot moves randomly, we can create a matrix of where a robot could move
     # Each row represents the starting position, and the column represents where the robot could end up
     def random_movement_matrix(self):
-        # To help keep things concise
-        w = self.colored_maze.width
-        h = self.colored_maze.height
-
-        movement_matrix = np.array([[float(0.0) for _ in range(w * h)] for _ in range(w * h)])
-
-        for loc in range(w * h):
-            # Check if this space is a floor tile
-            if self.colored_maze.is_floor_index(loc):
-                # Get the possible locations we could have moved (or not moved - hitting a wall)
-                possible_locations = self.colored_maze.blind_movements_indices(loc)
-                # This allows for repeated locations. If we have two walls bordering loc, the probability of
-                #   staying in the same spot is 0.5
-                for move_loc in possible_locations:
-                    movement_matrix[loc][move_loc] += 0.25
+        movement_matrix = np.zeros((self.num_states, self.num_states))
+        # This allows for repeated locations. If we have two walls bordering loc, the probability of
+        #   staying in the same spot is 0.5
+        rows, cols = self.random_movement_entries()
+        np.add.at(movement_matrix, (rows, cols), 0.25)
 
         return movement_matrix
 
+    # Same as random_movement_matrix, but as a scipy CSR matrix that only stores the nonzero entries
+    # Repeated locations from blind_movements_indices are summed together when the matrix is built
+    def sparse_random_movement_matrix(self):
+        rows, cols = self.random_movement_entries()
+        data = np.full(len(rows), 0.25)
+        return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(self.num_states, self.num_states))
+
+    # The (row, column) of every 0.25 in the random movement matrix: each floor space, and the possible locations
+    #   we could have moved (or not moved - hitting a wall) to from it, from blind_movements_indices
+    def random_movement_entries(self):
+        floor = self.colored_maze.get_floor_grid().ravel()
+        movements_table = self.colored_maze.get_blind_movements_table()
+        rows = np.repeat(np.flatnonzero(floor), 4)
+        cols = movements_table[floor].ravel()
+        return rows, cols
+
     # Given a previous state of probabilities and new sensor data, return the next probability state
     def get_next_state(self, prev_state, sensor_data, move=None):
         predicted_state = self.prediction_step(prev_state, move)
@@ -104,27 +588,99 @@ class FilteringMazePredictor:
         next_state = self.sensor_update_step(predicted_state, sensor_data)
 
         # Now we adjust this to that it is a probability distribution (adds up to 1)
-        adjustment = 1 / sum(next_state)
-        for i in range(len(next_state)):
-            next_state[i] *= adjustment
+        # Done the same way as solve_batch, so both agree up to rounding (the dense backend's matrix-matrix and
+        #   matrix-vector products can differ in the last bit)
+        adjustment = 1 / np.sum(next_state)
+        next_state *= adjustment
 
         return next_state
 
     # Given a previous state of probabilities, multiply that by the movement matrix to get the predicted state
     #   without accounting for the sensor
+    # The @ operator works for both the dense numpy matrices and the scipy sparse matrices
     def prediction_step(self, prev_state, move=None):
-        # See if we know which direction we tried to move in
+        # See if we know which direction we tried to move in. This is the same as multiplying by the direction
+        #   matrix, but O(w * h) instead of O((w * h)^2)
         if move:
-            return np.matmul(self.direction_matrices[move], prev_state)
+            return np.asarray(prev_state)[self.direction_targets[move]]
 
         # If not, assume we moved a random direction
-        return np.matmul(self.movement_matrix, prev_state)
+        if self.backend == "stencil":
+            return self.stencil_prediction_step(prev_state)
+        return self.movement_matrix @ prev_state
+
+    # Multiplies a vector by the transpose of the matrix used in prediction_step. This is what carries information
+    #   backwards in time (e.g. for smoothing), where prediction_step carries it forwards
+    def prediction_step_transpose(self, vector, move=None):
+        if move:
+            # The transpose of gathering from the targets is adding each value onto its target
+            return np.bincount(self.direction_targets[move], weights=vector, minlength=len(vector))
+
+        # Among floor spaces the random movement matrix is symmetric, and walls have no probability in or out of
+        #   them, so the stencil step is its own transpose
+        if self.backend == "stencil":
+            return self.stencil_prediction_step(vector)
+        return self.movement_matrix.T @ vector
+
+    # The same random movement prediction step as above, without any matrices. For every direction, each space
+    #   takes the probability of its neighbour in that direction, or keeps its own probability if that move hits a wall
+    def stencil_prediction_step(self, prev_state):
+        grid = np.reshape(prev_state, (self.colored_maze.height, self.colored_maze.width))
+
+        # Moving randomly is a quarter of each of the four directions, and walls never keep any probability
+        predicted = np.zeros(grid.shape)
+        for direction in self.DIRECTIONS:
+            shift, axis = self.STENCIL_SHIFTS[direction]
+            predicted += np.where(self.open_direction_grids[direction], np.roll(grid, shift, axis=axis), grid)
+
+        return (0.25 * predicted * self.floor_grid).ravel()
 
     # Given the predictions and the sensor data, return the predicted state that aligns with the sensor data
+    # Without sensor data (None), only the walls are ruled out
     def sensor_update_step(self, predictions, sensor_data):
+        if sensor_data is None:
+            return predictions * self.likelihood_table[self.NO_READING]
         return predictions * self.color_vectors[sensor_data]
 
 
+# Lookup tables from a byte to its index in FilteringMazePredictor.COLORS / DIRECTIONS, with 255 for anything invalid
+# Bytes that are already indices map to themselves, so encoded logs can be passed straight through
+_INVALID_CODE = 255
+_COLOR_CODES = np.full(256, _INVALID_CODE, dtype=np.uint8)
+for _i, _color in enumerate(FilteringMazePredictor.COLORS):
+    _COLOR_CODES[_i] = _i
+    _COLOR_CODES[ord(_color)] = _i
+_COLOR_CODES[FilteringMazePredictor.NO_READING] = FilteringMazePredictor.NO_READING
+_DIRECTION_CODES = np.full(256, _INVALID_CODE, dtype=np.uint8)
+for _i, _direction in enumerate(FilteringMazePredictor.DIRECTIONS):
+    _DIRECTION_CODES[_i] = _i
+    _DIRECTION_CODES[ord(_direction)] = _i
+_DIRECTION_CODES[FilteringMazePredictor.RANDOM_MOVE] = FilteringMazePredictor.RANDOM_MOVE
+
+
+# Encodes a sequence of chars, a bytes object or a numpy array into a uint8 array using the lookup table
+def _encode(values, lookup, name):
+    if isinstance(values, str):
+        values = values.encode("ascii")
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        raw = np.frombuffer(values, dtype=np.uint8)
+    else:
+        values = np.asarray(values)
+        if values.size == 0:
+            return np.zeros(values.shape, dtype=np.uint8)
+        if values.dtype.kind in "US":
+            raw = values.astype("S1").view(np.uint8).reshape(values.shape)
+        elif values.dtype.kind in "iu" and values.min() >= 0 and values.max() < 256:
+            raw = values.astype(np.uint8, copy=False)
+        else:
+            raise ValueError(f"Invalid {name} array of type {values.dtype}")
+
+    codes = lookup[raw]
+    if (codes == _INVALID_CODE).any():
+        raise ValueError(f"Invalid {name} in {raw[codes == _INVALID_CODE][:5]}")
+    return codes
+
+
 if __name__ == "__main__":
     Fil = FilteringMazePredictor(ColoredMaze("./mazes/maze1"))
     # print(Fil.movement_matrix)
@@ -0,0 +1,69 @@
+import sys
+
+import numpy as np
+
+
+# A stateful filtering session built on top of a FilteringMazePredictor.
+# Instead of replaying the whole history of sensor readings from the initial state every time a new reading
+#   arrives (which is what solve_for_probability_distribution does), the session keeps the current belief and
+#   only applies get_next_state once per new (reading, move) pair.
+class FilteringSession:
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.belief = None
+        self.steps = 0
+        self.reset()
+
+    # Go back to the predictor's initial state, as if no readings have been made
+    def reset(self):
+        self.belief = np.array(self.predictor.initial_state, dtype=float)
+        self.steps = 0
+
+    # Take one new sensor reading (and optionally the move that was attempted before it) into account
+    # Returns the updated probability distribution
+    def update(self, sensor_data, move=None):
+        self.belief = self.predictor.get_next_state(self.belief, sensor_data, move)
+        self.steps += 1
+        return self.belief
+
+    # Take a sequence of sensor readings (and optionally moves) into account, one step at a time
+    # The lengths of both lists must be the same if movements are provided
+    def extend(self, sensor_readings, movements=None):
+        if movements:
+            if len(sensor_readings) != len(movements):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+        for i in range(len(sensor_readings)):
+            if movements:
+                self.update(sensor_readings[i], movements[i])
+            else:
+                self.update(sensor_readings[i])
+
+        return self.belief
+
+    # Returns a copy of the session's current state that can later be handed to restore()
+    def snapshot(self):
+        return self.steps, self.belief.copy()
+
+    # Go back to a state previously returned by snapshot()
+    def restore(self, snapshot):
+        steps, belief = snapshot
+        if len(belief) != len(self.predictor.initial_state):
+            print("Snapshot does not match the size of this maze", file=sys.stderr)
+            return
+        self.steps = steps
+        self.belief = np.array(belief, dtype=float)
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+    from FilteringMazePredictor import FilteringMazePredictor
+
+    Fil = FilteringMazePredictor(ColoredMaze("./mazes/maze1"))
+    session = FilteringSession(Fil)
+    session.extend(["r", "g", "r"])
+    saved = session.snapshot()
+    session.extend(["g", "b"])
+    Fil.colored_maze.illustrate_probabilities(session.belief)
+    session.restore(saved)
+    Fil.colored_maze.illustrate_probabilities(session.belief)
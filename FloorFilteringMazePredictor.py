@@ -0,0 +1,85 @@
+import numpy as np
+
+from FilteringMazePredictor import FilteringMazePredictor
+
+
+# A FilteringMazePredictor whose beliefs only have an entry for each floor space. The robot can never be on a wall,
+#   so wall entries only ever hold zeros, yet they cost memory and time in every step. On mazes with a lot of walls
+#   this makes every matrix, vector and step that much smaller.
+# Floor space f (its floor id) is the f-th floor space in the order of the maze map, so floor_indices[f] is its index
+#   in the maze, and floor_ids[index] is the floor id of a space (-1 for walls). Use to_grid_state to turn a belief
+#   back into the layout of the maze map, e.g. for illustrate_probabilities.
+# The initial state is uniform over the floor spaces, without the hundredth of the probability that the full
+#   predictor puts on each wall. Walls lose that probability on the first step anyway, so every belief is the same as
+#   the full predictor's (on the floor spaces), but log-likelihoods are those of starting on the floor for sure.
+# The stencil backend works on the full (h, w) grid, so only the dense and sparse backends are supported.
+class FloorFilteringMazePredictor(FilteringMazePredictor):
+    BACKENDS = ("dense", "sparse")
+    COMMON_MODEL_ARRAY_NAMES = FilteringMazePredictor.COMMON_MODEL_ARRAY_NAMES + ("floor_indices",)
+
+    @property
+    def num_states(self):
+        return len(self.floor_indices)
+
+    # The maze index of every floor id
+    @property
+    def floor_indices(self):
+        return self._get_model_array("floor_indices")
+
+    # The floor id of every space in the maze, or -1 for walls
+    @property
+    def floor_ids(self):
+        if self._floor_ids is None:
+            self._floor_ids = np.full(self.colored_maze.width * self.colored_maze.height, -1, dtype=np.intp)
+            self._floor_ids[self.floor_indices] = np.arange(len(self.floor_indices))
+        return self._floor_ids
+
+    # Walls get a probability of 0
+    def to_grid_state(self, state):
+        grid_state = np.zeros(self.colored_maze.width * self.colored_maze.height)
+        grid_state[self.floor_indices] = state
+        return grid_state
+
+    # Returns the beliefs of the floor spaces from a belief in the layout of the maze map
+    def from_grid_state(self, grid_state):
+        return np.asarray(grid_state)[self.floor_indices]
+
+    # We assume that we can be in any floor location of the maze with equal probability
+    def get_initial_state(self):
+        return np.full(self.num_states, 1 / self.num_states)
+
+    # The same entries as the full predictor's, between floor ids. Moves from a floor space always end on a floor
+    #   space, and walls have no entries
+    def random_movement_entries(self):
+        movements_table = self.colored_maze.get_blind_movements_table()
+        rows = np.repeat(np.arange(self.num_states), 4)
+        cols = self.floor_ids[movements_table[self.floor_indices]].ravel()
+        return rows, cols
+
+    def _build_model_array(self, name):
+        if name == "floor_indices":
+            return {name: np.flatnonzero(self.colored_maze.floor_mask)}
+
+        # The full predictor's likelihoods and direction targets, for (and between) the floor spaces only
+        if name == "likelihood_table":
+            full_table = super()._build_model_array(name)[name]
+            return {name: full_table[:, self.floor_indices]}
+        if name == "direction_target_table":
+            full_table = np.stack([self.colored_maze.get_direction_targets(direction)
+                                   for direction in self.DIRECTIONS])
+            return {name: self.floor_ids[full_table[:, self.floor_indices]]}
+
+        return super()._build_model_array(name)
+
+    def _set_model_arrays(self, model_arrays):
+        super()._set_model_arrays(model_arrays)
+        self._floor_ids = None
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+
+    Fil = FloorFilteringMazePredictor(ColoredMaze("./mazes/maze16x16"))
+    print(f"{Fil.num_states} floor states instead of {Fil.colored_maze.width * Fil.colored_maze.height} spaces")
+    readings = ["g", "g", "r", "y", "b", "b", "b", "b"]
+    Fil.colored_maze.illustrate_probabilities(Fil.to_grid_state(Fil.solve_for_probability_distribution(readings)))
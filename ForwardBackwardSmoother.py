@@ -0,0 +1,122 @@
+import math
+
+import numpy as np
+
+
+# Forward-backward smoothing on top of a FilteringMazePredictor.
+# Filtering gives P(location at t | readings 1..t). Smoothing also uses the readings that came after t, giving
+#   P(location at t | readings 1..T), which is what we want when looking back at a whole trajectory.
+# The forward pass is the same as the predictor's filter. The backward pass carries the likelihood of the later
+#   readings back in time with the transpose of the same movement matrices and the same color vectors.
+# smooth returns all T smoothed distributions at once, so it keeps the forward states of its only forward pass in the
+#   result. For sequences too long for T distributions to fit in memory, iter_smoothed only keeps every k-th forward
+#   state (k = sqrt(T) by default), and recomputes the forward states inside a segment from its checkpoint when the
+#   backward pass reaches it. This keeps O(sqrt(T)) states in memory instead of T, at the cost of running the forward
+#   pass twice.
+class ForwardBackwardSmoother:
+    def __init__(self, predictor):
+        self.predictor = predictor
+
+    # Returns a (T, w * h) array where row t is the smoothed probability distribution after reading t + 1
+    # Parameter: A list of chars in {'r', 'g', 'b', 'y'} as sensor readings (or their encoded indices)
+    # Optional Parameter: A list of moves in {'N', 'E', 'S', 'W'} as the moves the robot has taken
+    # The result holds all T distributions, so for very long sequences use iter_smoothed instead
+    def smooth(self, sensor_readings, movements=None):
+        encoded = self.predictor.encode_sequence(sensor_readings, movements)
+        if encoded is None:
+            return None
+        reading_codes, move_codes = encoded
+        reading_codes = reading_codes.tolist()
+        move_codes = move_codes.tolist()
+        num_steps = len(reading_codes)
+
+        # Forward pass, straight into the result
+        smoothed_states = np.zeros((num_steps, len(self.predictor.initial_state)))
+        current_state = self.predictor.initial_state
+        for t in range(num_steps):
+            current_state = self.predictor.get_next_state_scaled(current_state, reading_codes[t], move_codes[t])[0]
+            smoothed_states[t] = current_state
+
+        # Backward pass, weighting each forward state by the likelihood of the readings after it
+        backward_message = np.ones(len(self.predictor.initial_state))
+        for t in range(num_steps - 1, -1, -1):
+            smoothed_states[t] = self._normalize(smoothed_states[t] * backward_message)
+            backward_message = self._backward_step(backward_message, reading_codes[t], move_codes[t])
+
+        return smoothed_states
+
+    # Yields (t, smoothed distribution after reading t + 1) for every step, from the last step back to the first
+    # Only one segment of forward states is kept at a time. By default segments are sqrt(T) steps long
+    def iter_smoothed(self, sensor_readings, movements=None, segment_length=None):
+        encoded = self.predictor.encode_sequence(sensor_readings, movements)
+        if encoded is None:
+            return
+        reading_codes, move_codes = encoded
+        reading_codes = reading_codes.tolist()
+        move_codes = move_codes.tolist()
+        num_steps = len(reading_codes)
+        if num_steps == 0:
+            return
+        if segment_length is None:
+            segment_length = max(1, math.ceil(math.sqrt(num_steps)))
+
+        # Forward pass, only keeping the state at the start of every segment
+        checkpoints = []
+        current_state = self.predictor.initial_state
+        for t in range(num_steps):
+            if t % segment_length == 0:
+                checkpoints.append(current_state)
+            current_state = self.predictor.get_next_state_scaled(current_state, reading_codes[t], move_codes[t])[0]
+
+        # Backward pass, one segment at a time from the end
+        backward_message = np.ones(len(self.predictor.initial_state))
+        for segment in range(len(checkpoints) - 1, -1, -1):
+            start = segment * segment_length
+            end = min(start + segment_length, num_steps)
+
+            # Recompute the forward states of this segment from its checkpoint
+            forward_states = []
+            current_state = checkpoints[segment]
+            for t in range(start, end):
+                current_state = self.predictor.get_next_state_scaled(current_state, reading_codes[t],
+                                                                     move_codes[t])[0]
+                forward_states.append(current_state)
+
+            for t in range(end - 1, start - 1, -1):
+                yield t, self._normalize(forward_states[t - start] * backward_message)
+                backward_message = self._backward_step(backward_message, reading_codes[t], move_codes[t])
+
+            # Free the segment before recomputing the previous one
+            checkpoints[segment] = None
+
+    # Given the likelihood of readings t + 1..T from every location at time t, returns the likelihood of
+    #   readings t..T from every location at time t - 1 (scaled, since only the relative values matter)
+    def _backward_step(self, backward_message, color_code, move_code):
+        move = None
+        if move_code != self.predictor.RANDOM_MOVE:
+            move = self.predictor.DIRECTIONS[move_code]
+        message = self.predictor.prediction_step_transpose(
+            backward_message * self.predictor.likelihood_table[color_code], move)
+        return self._normalize(message, fallback=backward_message)
+
+    # Scales a vector so that it adds up to 1. If it is all zeros, returns the fallback (or a uniform vector)
+    @staticmethod
+    def _normalize(vector, fallback=None):
+        total = np.sum(vector)
+        if not (0 < total < np.inf):
+            if fallback is not None:
+                return fallback
+            return np.full(len(vector), 1 / len(vector))
+        return vector * (1 / total)
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+    from FilteringMazePredictor import FilteringMazePredictor
+
+    Fil = FilteringMazePredictor(ColoredMaze("./mazes/maze1"))
+    smoother = ForwardBackwardSmoother(Fil)
+    smoothed = smoother.smooth(["r", "g", "r", "g", "b"])
+    for step in range(len(smoothed)):
+        print(f"Smoothed distribution after reading {step + 1}:")
+        Fil.colored_maze.illustrate_probabilities(smoothed[step])
@@ -0,0 +1,240 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# Without scipy, the operators are full matrices
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+
+# Speeds up a FilteringMazePredictor's filter on sequences with long runs of the same (move, reading) pair, like
+#   a robot sitting still and reading green over and over, or pushing into the same wall.
+# One filtering step is a move (movement or direction matrix) followed by a sensor update (multiplying by a color
+#   vector), which together is a single matrix: the fused operator diag(color vector) @ movement matrix. There are
+#   only 4 colors times 5 moves (4 directions and a random move) of these. A run of k identical steps is the fused
+#   operator to the power of k, and powers of 2 of it are found by repeated squaring, so the run takes O(log k)
+#   matrix-vector products instead of k steps.
+# The operators are scipy CSR matrices, so they only cost as much as their nonzero entries: the fused operator of a
+#   known move has one entry per row and so do all of its powers, and the powers of a random move only fill in as
+#   far as the robot could have wandered. Without scipy they are full (w * h, w * h) matrices, which are only built
+#   when they fit in memory_budget. A run only squares its way up while that costs a small share of taking its steps
+#   one at a time (see fast_forward), so on big mazes the squarings stop as soon as the powers fill in.
+# The powers are kept in a least-recently-used cache that evicts the oldest ones once their total size is over
+#   memory_budget bytes.
+# Sensor dropouts (random moves without readings) are handed to the predictor's predict_unobserved, which is much
+#   cheaper than powers of the movement matrix. Steps without a reading after a known move are fused with the floor
+#   mask, so they are runs like any other.
+# Powers of an operator stop changing once the filter has forgotten where it started, and once squaring gives back the
+#   same power (every entry to within convergence_tolerance of itself) that power is used for every longer run as
+#   well. Powers of a known move rarely converge, since the likelihoods of the paths keep drifting apart.
+class FusedOperatorCache:
+    # When applying a (scaled) power leaves less than this, entries that underflowed in the power could have mattered
+    UNDERFLOW_LIMIT = np.sqrt(np.finfo(float).tiny)
+    # The most the squarings for a run can cost, as a share of taking its steps one at a time. A multiplication in a
+    #   sparse product is a few times slower than one in a step, and the powers it makes are slower to apply
+    MAX_SQUARING_SHARE = 0.25
+
+    def __init__(self, predictor, memory_budget=64 * 1024 * 1024, min_run_length=4, convergence_tolerance=1e-12):
+        self.predictor = predictor
+        self.memory_budget = memory_budget
+        # Runs shorter than this are always done one step at a time with the predictor
+        self.min_run_length = min_run_length
+        self.convergence_tolerance = convergence_tolerance
+        # Maps (move code, color code) to the power of 2 at which powers of its fused operator stopped changing
+        self.converged_exponents = dict()
+
+        # Maps (move code, color code, power of 2) to that power of the fused operator
+        self.operators = OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Same as the predictor's solve_for_probability_distribution (or solve_encoded), but runs of identical
+    #   (move, reading) pairs are fast-forwarded with powers of the fused operator, and sensor dropouts are skipped
+    #   with the predictor's predict_unobserved
+    def solve_for_probability_distribution(self, sensor_readings, movements=None):
+        encoded = self.predictor.encode_sequence(sensor_readings, movements)
+        if encoded is None:
+            return None
+        reading_codes, move_codes = encoded
+
+        current_state = self.predictor.initial_state
+        for start, length in self.runs(reading_codes, move_codes):
+            color_code = int(reading_codes[start])
+            move_code = int(move_codes[start])
+            if color_code == self.predictor.NO_READING and move_code == self.predictor.RANDOM_MOVE:
+                # Random moves without readings never need the fused operator
+                current_state = self.predictor.predict_unobserved(current_state, length)
+            elif length >= self.min_run_length and self.can_build(move_code):
+                current_state = self.fast_forward(current_state, color_code, move_code, length)
+            else:
+                for _ in range(length):
+                    current_state = self.predictor.get_next_state_encoded(current_state, color_code, move_code)
+
+        return current_state
+
+    # Whether the fused operator of a move can be built at all. Only the full matrices used without scipy can be too
+    #   big for the memory budget
+    def can_build(self, move_code):
+        return scipy is not None or self.predictor.num_states ** 2 * 8 <= self.memory_budget
+
+    # Apply `length` identical steps of (reading, move) to the state, with O(log length) matrix-vector products
+    # Squarings are only done while all of the ones for this run (counted in multiplications, see squaring_cost) add
+    #   up to at most MAX_SQUARING_SHARE of the cost of taking the run's steps one at a time. Once the next one would
+    #   go over, the rest of the run is done one step at a time instead, so a run whose powers fill in too fast costs
+    #   about the same as with the plain filter. Powers that are already cached are free
+    def fast_forward(self, state, color_code, move_code, length):
+        if move_code == self.predictor.RANDOM_MOVE:
+            # 4 entries for every floor space, which is where the floor row of the likelihood table is nonzero
+            step_nonzeros = 4 * np.count_nonzero(self.predictor.likelihood_table[self.predictor.NO_READING])
+        else:
+            step_nonzeros = self.predictor.num_states
+        squaring_budget = self.MAX_SQUARING_SHARE * length * (step_nonzeros + self.predictor.num_states)
+
+        exponent = 1
+        operator = self.power(move_code, color_code, exponent)
+        while length > 0:
+            converged_exponent = self.converged_exponents.get((move_code, color_code))
+            if converged_exponent is not None and exponent >= converged_exponent:
+                # Everything that is left of the run is a power past the converged one, so it is the same power
+                length = 1
+            if length & 1:
+                # The powers are scaled, so only the direction of the state matters until the end
+                next_state = operator @ state
+                total = np.sum(next_state)
+                if total > self.UNDERFLOW_LIMIT:
+                    state = next_state * (1 / total)
+                else:
+                    # Everything the state could reach is so unlikely next to the largest entry of the power that it
+                    #   underflowed (or the readings are impossible), so these steps are taken one at a time
+                    for _ in range(exponent):
+                        state = self.predictor.get_next_state_encoded(state, color_code, move_code)
+            length >>= 1
+            if length == 0:
+                break
+
+            if (move_code, color_code, exponent * 2) not in self.operators:
+                squaring_budget -= self.squaring_cost(operator)
+                if squaring_budget < 0:
+                    # The steps that are left are the rest of the bits, each worth twice as many as the one before
+                    for _ in range(length * exponent * 2):
+                        state = self.predictor.get_next_state_encoded(state, color_code, move_code)
+                    break
+            exponent <<= 1
+            operator = self.power(move_code, color_code, exponent, operator)
+
+        return state
+
+    # The number of multiplications it takes to square an operator: every entry of column k meets every entry of row k
+    def squaring_cost(self, operator):
+        if scipy is None:
+            return self.predictor.num_states ** 3
+        row_nonzeros = np.diff(operator.indptr)
+        column_nonzeros = np.bincount(operator.indices, minlength=operator.shape[1])
+        return int(np.dot(row_nonzeros, column_nonzeros))
+
+    # Returns the fused operator for (move, reading) to the power of exponent (which must be a power of 2), scaled so
+    #   that its largest entry is 1. Scaling does not change the result once the state is normalized, and keeps large
+    #   powers from underflowing
+    # Powers past the converged one are the converged power. The power at exponent // 2 can be passed in as half, so
+    #   that it does not have to be built again when it was too big to cache
+    def power(self, move_code, color_code, exponent, half=None):
+        converged_exponent = self.converged_exponents.get((move_code, color_code))
+        if converged_exponent is not None:
+            exponent = min(exponent, converged_exponent)
+        key = (move_code, color_code, exponent)
+        if key in self.operators:
+            self.hits += 1
+            self.operators.move_to_end(key)
+            return self.operators[key]
+
+        self.misses += 1
+        if exponent == 1:
+            operator = self.fused_operator(move_code, color_code)
+        else:
+            if half is None:
+                half = self.power(move_code, color_code, exponent // 2)
+            operator = half @ half
+            largest = operator.max()
+            if largest > 0:
+                operator = operator * (1 / largest)
+            if not (abs(operator - half) > self.convergence_tolerance * operator).sum():
+                self.converged_exponents[(move_code, color_code)] = exponent
+
+        self._store(key, operator)
+        return operator
+
+    # Builds diag(color vector) @ movement matrix for the move and reading, as a CSR matrix (or a full matrix without
+    #   scipy). Without a reading, the color vector is the floor mask
+    def fused_operator(self, move_code, color_code):
+        num_locations = self.predictor.num_states
+        if move_code == self.predictor.RANDOM_MOVE:
+            rows, columns = self.predictor.random_movement_entries()
+            values = np.full(len(rows), 0.25)
+        else:
+            rows = np.arange(num_locations)
+            columns = self.predictor.direction_target_table[move_code]
+            values = np.ones(num_locations)
+        values *= self.predictor.likelihood_table[color_code][rows]
+
+        if scipy is None:
+            operator = np.zeros((num_locations, num_locations))
+            np.add.at(operator, (rows, columns), values)
+            return operator
+        # Walls have no likelihood, so their rows are left out altogether
+        nonzero = values != 0
+        return scipy.sparse.csr_matrix((values[nonzero], (rows[nonzero], columns[nonzero])),
+                                       shape=(num_locations, num_locations))
+
+    # Empty the cache
+    def clear(self):
+        self.operators.clear()
+        self.converged_exponents.clear()
+        self.cache_bytes = 0
+
+    # The fraction of operator lookups that were already in the cache
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.0
+        return self.hits / (self.hits + self.misses)
+
+    @staticmethod
+    # Splits encoded readings and moves into runs of identical (reading, move) pairs, as (start, length) tuples
+    def runs(reading_codes, move_codes):
+        if len(reading_codes) == 0:
+            return []
+        changes = np.flatnonzero((np.diff(reading_codes) != 0) | (np.diff(move_codes) != 0)) + 1
+        starts = np.concatenate(([0], changes))
+        lengths = np.diff(np.concatenate((starts, [len(reading_codes)])))
+        return list(zip(starts.tolist(), lengths.tolist()))
+
+    # Add an operator to the cache, evicting the least recently used ones until it fits in the memory budget
+    # An operator that is bigger than the budget by itself is not kept at all
+    def _store(self, key, operator):
+        if _nbytes(operator) > self.memory_budget:
+            return
+        self.operators[key] = operator
+        self.cache_bytes += _nbytes(operator)
+        while self.cache_bytes > self.memory_budget:
+            _, evicted = self.operators.popitem(last=False)
+            self.cache_bytes -= _nbytes(evicted)
+
+
+# The memory an operator takes up, as a full matrix or as its three CSR arrays
+def _nbytes(operator):
+    if isinstance(operator, np.ndarray):
+        return operator.nbytes
+    return operator.data.nbytes + operator.indices.nbytes + operator.indptr.nbytes
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+    from FilteringMazePredictor import FilteringMazePredictor
+
+    Fil = FilteringMazePredictor(ColoredMaze("./mazes/maze8x8"))
+    cache = FusedOperatorCache(Fil)
+    all_greens = ["g"] * 100000
+    Fil.colored_maze.illustrate_probabilities(cache.solve_for_probability_distribution(all_greens))
+    print(f"Cached operators: {len(cache.operators)} ({cache.cache_bytes} bytes), hit rate {cache.hit_rate():.2f}")
@@ -0,0 +1,110 @@
+import sys
+
+import numpy as np
+
+from FilteringMazePredictor import FilteringMazePredictor
+
+
+# Runs the filter on the blocks of the maze's bisimulation partition (see ColoredMaze.get_bisimulation_partition)
+#   instead of on every space. The spaces in a block have the same color and the same chance of moving into each
+#   block, so a belief that is even over every block stays even over every block, and the filter only needs the
+#   total probability of each block. On mazes with large regular regions there are far fewer blocks than spaces.
+# If R[B, C] is the chance of a space in block B moving into block C (the sum of its movement matrix row over the
+#   spaces of C), then the probability of block B after a step is sum over C of |B| * R[B, C] / |C| times the
+#   probability of block C. This is the quotient chain that the filter runs on, stored as its nonzero entries.
+# Use to_grid_state to spread the probability of every block evenly over its spaces. Like
+#   FloorFilteringMazePredictor, the initial state is uniform over the floor spaces with none of it on the walls.
+# With directional=False the blocks only need to agree on random moves, which gives fewer of them, but then every
+#   move has to be random.
+class LumpedFilter:
+    def __init__(self, colored_maze, directional=True):
+        self.colored_maze = colored_maze
+        self.directional = directional
+        self.labels, self.num_blocks = colored_maze.get_bisimulation_partition(directional)
+        floor = self.labels >= 0
+        self.block_sizes = np.bincount(self.labels[floor], minlength=self.num_blocks)
+
+        # Every space in a block behaves the same, so each block is built from its first space
+        first_spaces = np.full(self.num_blocks, len(self.labels), dtype=np.intp)
+        np.minimum.at(first_spaces, self.labels[floor], np.flatnonzero(floor))
+        # The block that each direction moves every block into, in the order of FilteringMazePredictor.DIRECTIONS
+        neighbour_blocks = self.labels[colored_maze.neighbour_table[first_spaces]]
+
+        # Random moves: each of the 4 moves from a block adds 0.25 * |B| / |C| for the block C it moves into
+        self.movement_rows = np.repeat(np.arange(self.num_blocks), 4)
+        self.movement_columns = neighbour_blocks.ravel()
+        self.movement_values = 0.25 * self.block_sizes[self.movement_rows] / self.block_sizes[self.movement_columns]
+
+        # Known moves: every block takes all of its probability from a single block
+        self.direction_target_table = np.ascontiguousarray(neighbour_blocks.T)
+        self.direction_scale_table = self.block_sizes / self.block_sizes[self.direction_target_table]
+
+        # Colors as in the predictor's likelihood table, with a row of ones for steps without a reading
+        likelihood_table = np.stack([colored_maze.get_color_vector(color) for color in FilteringMazePredictor.COLORS])
+        self.likelihood_table = np.vstack((likelihood_table[:, first_spaces], np.ones(self.num_blocks)))
+
+        self.initial_state = self.block_sizes / np.sum(self.block_sizes)
+
+    # The fraction of the floor spaces that the filter needs a probability for
+    def compression_ratio(self):
+        return self.num_blocks / max(np.sum(self.block_sizes), 1)
+
+    # Same as the predictor's solve_for_probability_distribution, returned in the layout of the maze map
+    def solve_for_probability_distribution(self, sensor_readings, movements=None):
+        block_state = self.solve_encoded(sensor_readings, movements)
+        if block_state is None:
+            return None
+        return self.to_grid_state(block_state)
+
+    # Returns the probability of every block after the readings (and moves), which may be encoded like the
+    #   predictor's solve_encoded. Readings can be None for steps without one
+    def solve_encoded(self, reading_codes, move_codes=None):
+        reading_codes = FilteringMazePredictor.encode_readings(reading_codes)
+        if move_codes is None:
+            move_codes = np.full(len(reading_codes), FilteringMazePredictor.RANDOM_MOVE, dtype=np.uint8)
+        else:
+            move_codes = FilteringMazePredictor.encode_moves(move_codes)
+            if len(reading_codes) != len(move_codes):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+
+        current_state = self.initial_state
+        for color_code, move_code in zip(reading_codes.tolist(), move_codes.tolist()):
+            current_state = self.get_next_state_encoded(current_state, color_code, move_code)
+
+        return current_state
+
+    # One step of the filter on the block probabilities
+    def get_next_state_encoded(self, prev_state, color_code, move_code=FilteringMazePredictor.RANDOM_MOVE):
+        if move_code == FilteringMazePredictor.RANDOM_MOVE:
+            next_state = np.bincount(self.movement_rows, minlength=self.num_blocks,
+                                     weights=self.movement_values * prev_state[self.movement_columns])
+        elif self.directional:
+            next_state = prev_state[self.direction_target_table[move_code]] * self.direction_scale_table[move_code]
+        else:
+            raise ValueError("Known moves need the directional partition (directional=True)")
+
+        next_state *= self.likelihood_table[color_code]
+        next_state *= 1 / np.sum(next_state)
+        return next_state
+
+    # Spread the probability of every block evenly over its spaces, in the layout of the maze map. Walls get 0
+    def to_grid_state(self, block_state):
+        floor = self.labels >= 0
+        grid_state = np.zeros(len(self.labels))
+        grid_state[floor] = (block_state / self.block_sizes)[self.labels[floor]]
+        return grid_state
+
+    # Add up the probability of every block from a belief in the layout of the maze map
+    def from_grid_state(self, grid_state):
+        floor = self.labels >= 0
+        return np.bincount(self.labels[floor], weights=np.asarray(grid_state)[floor], minlength=self.num_blocks)
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+
+    lumped_filter = LumpedFilter(ColoredMaze("./mazes/disconnectedComponents"))
+    print(f"{lumped_filter.num_blocks} blocks for {np.sum(lumped_filter.block_sizes)} floor spaces")
+    readings = ["g", "g", "g", "y", "g", "g"]
+    lumped_filter.colored_maze.illustrate_probabilities(lumped_filter.solve_for_probability_distribution(readings))
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from FilteringMazePredictor import FilteringMazePredictor
+
+
+# Saves built FilteringMazePredictor models to disk so that loading the same maze again (like every time the GUI
+#   swaps mazes) does not have to build the movement matrix, color vectors and direction targets again.
+# Each model is a folder of .npy files, one per model array, named by a hash of everything the model depends on: the
+#   maze's size and spaces, the sensor model, the predictor class, the backend and the cache format version. Changing
+#   any of those gives a different key, so old models are never used by mistake. Cached arrays are opened
+#   memory-mapped and read-only, so loading only reads the parts of the files that the filter actually touches.
+class ModelCache:
+    # Bump this whenever the model arrays change, so older caches are not loaded
+    FORMAT_VERSION = 3
+    MANIFEST = "manifest.json"
+
+    def __init__(self, cache_dir="./.model_cache"):
+        self.cache_dir = cache_dir
+
+    # The hash that identifies a model for this maze, backend and predictor class (FilteringMazePredictor or a subclass
+    #   like FloorFilteringMazePredictor, which builds different model arrays)
+    def key(self, colored_maze, backend="dense", predictor_class=FilteringMazePredictor):
+        digest = hashlib.sha256()
+        header = {
+            "version": self.FORMAT_VERSION,
+            "predictor_class": f"{predictor_class.__module__}.{predictor_class.__qualname__}",
+            "backend": backend,
+            "width": colored_maze.width,
+            "height": colored_maze.height,
+            "sensor_accuracy": colored_maze.SENSOR_ACCURACY,
+            "sensor_error": colored_maze.SENSOR_ERROR,
+        }
+        digest.update(json.dumps(header, sort_keys=True).encode())
+        digest.update(colored_maze.color_codes.tobytes())
+        return digest.hexdigest()
+
+    # Returns a predictor for the maze, loaded from the cache if it is there, and built (and saved) if it is not
+    def load_predictor(self, colored_maze, backend="dense", predictor_class=FilteringMazePredictor):
+        model_dir = os.path.join(self.cache_dir, self.key(colored_maze, backend, predictor_class))
+        model_arrays = self._load(model_dir)
+        if model_arrays is not None:
+            return predictor_class.from_model_arrays(colored_maze, model_arrays, backend)
+
+        predictor = predictor_class(colored_maze, backend)
+        self._save(model_dir, predictor.build_model_arrays())
+        return predictor
+
+    # Whether a model for this maze, backend and predictor class is already cached
+    def contains(self, colored_maze, backend="dense", predictor_class=FilteringMazePredictor):
+        return os.path.exists(os.path.join(self.cache_dir, self.key(colored_maze, backend, predictor_class),
+                                           self.MANIFEST))
+
+    # Delete every cached model
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    # Memory-map the arrays of a cached model, or return None if it is not cached (or is from another version)
+    def _load(self, model_dir):
+        try:
+            with open(os.path.join(model_dir, self.MANIFEST), "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if manifest.get("version") != self.FORMAT_VERSION:
+            return None
+
+        model_arrays = dict()
+        for name in manifest["arrays"]:
+            # Plain ndarray views of the memory maps, so that results computed from them are not memmaps themselves
+            model_arrays[name] = np.asarray(np.load(os.path.join(model_dir, name + ".npy"), mmap_mode="r"))
+        return model_arrays
+
+    # Write the arrays into a temporary folder first and then move it into place, so that other processes never see
+    #   a half written model
+    def _save(self, model_dir, model_arrays):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        for name, array in model_arrays.items():
+            np.save(os.path.join(temp_dir, name + ".npy"), array)
+        with open(os.path.join(temp_dir, self.MANIFEST), "w") as f:
+            json.dump({"version": self.FORMAT_VERSION, "arrays": list(model_arrays)}, f)
+
+        try:
+            os.rename(temp_dir, model_dir)
+        except OSError:
+            # Another process saved the same model first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import time
+    from ColoredMaze import ColoredMaze
+
+    cache = ModelCache()
+    maze = ColoredMaze("./mazes/maze16x16")
+    for attempt in ["first", "second"]:
+        start = time.perf_counter()
+        Fil = cache.load_predictor(maze)
+        print(f"{attempt} load: {time.perf_counter() - start:.4f} seconds")
@@ -0,0 +1,254 @@
+import sys
+
+import numpy as np
+
+from ColoredMaze import ColoredMaze
+from FilteringMazePredictor import FilteringMazePredictor
+
+
+# Localizes on large mazes at two resolutions, so that each step costs about the size of the area the robot is
+#   likely to be in rather than the size of the maze.
+# Coarse level: the maze is cut into block_size x block_size blocks, and a filter runs on the probability of each
+#   block over the whole maze. It treats the probability inside a block as even, so the chance of a reading in a
+#   block comes from the block's color histogram, and the chance of moving from one block to another from how many
+#   of its floor spaces' moves cross into the other block.
+# Fine level: once the blocks holding window_mass of the coarse probability fit in a window of at most
+#   max_window_fraction of the maze, the exact filter (a FilteringMazePredictor) runs on just that window, plus a
+#   margin of blocks around it. Probability that moves out of the window is dropped. The fine belief replaces the
+#   coarse one inside the window, and the window shrinks onto the coarse belief as it sharpens.
+# If the coarse probability inside the window drops below min_window_mass (the robot was not where the window
+#   thought), the window is dropped and the search goes back to the whole maze until a new window can be found.
+# The whole maze is searched with the exact filter (exact_search=True), which is a window over all of it, or with the
+#   coarse level alone. The coarse level alone is much cheaper, but can only narrow down the search on mazes whose
+#   blocks have different colors from each other; on mazes where every block has about the same mix of colors, it
+#   never finds a window.
+class MultiResolutionFilter:
+    def __init__(self, colored_maze, block_size=8, window_mass=0.95, min_window_mass=0.5, max_window_fraction=0.25,
+                 margin=1, backend="stencil", exact_search=True):
+        self.colored_maze = colored_maze
+        self.exact_search = exact_search
+        self.block_size = block_size
+        self.window_mass = window_mass
+        self.min_window_mass = min_window_mass
+        self.max_window_spaces = max_window_fraction * colored_maze.width * colored_maze.height
+        self.margin = margin
+        self.backend = backend
+
+        height = colored_maze.height
+        width = colored_maze.width
+        self.block_rows = -(-height // block_size)
+        self.block_columns = -(-width // block_size)
+        self.num_blocks = self.block_rows * self.block_columns
+
+        # The block of every space in the maze
+        rows, columns = np.divmod(np.arange(width * height), width)
+        self.space_blocks = (rows // block_size) * self.block_columns + columns // block_size
+
+        # Color histogram (and number of floor spaces) of every block
+        floor = colored_maze.floor_mask
+        floor_blocks = self.space_blocks[floor]
+        num_colors = len(FilteringMazePredictor.COLORS)
+        histograms = np.reshape(np.bincount(floor_blocks * num_colors + colored_maze.color_codes[floor],
+                                            minlength=self.num_blocks * num_colors), (self.num_blocks, num_colors))
+        self.block_floor_sizes = np.sum(histograms, axis=1)
+        has_floor = self.block_floor_sizes > 0
+        sizes = np.maximum(self.block_floor_sizes, 1)
+
+        # The chance of each reading in each block, if the probability in the block is even over its floor spaces
+        #   (with a row for steps without a reading)
+        color_likelihoods = (histograms * colored_maze.SENSOR_ACCURACY
+                             + (sizes[:, np.newaxis] - histograms) * colored_maze.SENSOR_ERROR) / sizes[:, np.newaxis]
+        self.coarse_likelihood_table = np.vstack((color_likelihoods.T * has_floor, has_floor.astype(float)))
+
+        # The coarse moves as (rows, columns, values) entries. Block B gets value * P(C) from block C, where every
+        #   floor space of B that moves into C adds its share of C's probability
+        floor_neighbours = colored_maze.neighbour_table[floor]
+        target_blocks = self.space_blocks[floor_neighbours]
+        self.coarse_movement = self._coarse_entries(np.repeat(floor_blocks, 4), target_blocks.ravel(), 0.25, sizes)
+        self.coarse_directions = [self._coarse_entries(floor_blocks, target_blocks[:, i], 1.0, sizes)
+                                  for i in range(len(FilteringMazePredictor.DIRECTIONS))]
+        self.coarse_initial_state = self.block_floor_sizes / max(np.sum(self.block_floor_sizes), 1)
+
+        self.coarse_state = None
+        self.window = None
+        self.reset()
+
+    # Go back to the start: no window, and the coarse belief even over the floor
+    def reset(self):
+        self.coarse_state = self.coarse_initial_state.copy()
+        self.window = None
+        self._select_window()
+
+    # Take one new sensor reading (None for no reading) and optionally the move that was attempted before it
+    def update(self, sensor_data, move=None):
+        color_code = int(FilteringMazePredictor.encode_readings([sensor_data])[0])
+        move_code = FilteringMazePredictor.RANDOM_MOVE
+        if move:
+            move_code = int(FilteringMazePredictor.encode_moves([move])[0])
+
+        # The coarse level always covers the whole maze
+        if move_code == FilteringMazePredictor.RANDOM_MOVE:
+            rows, columns, values = self.coarse_movement
+        else:
+            rows, columns, values = self.coarse_directions[move_code]
+        coarse_state = np.bincount(rows, weights=values * self.coarse_state[columns], minlength=self.num_blocks)
+        coarse_state *= self.coarse_likelihood_table[color_code]
+        total = np.sum(coarse_state)
+        if not (0 < total < np.inf):
+            print("Sensor reading is impossible from this state", file=sys.stderr)
+            self.reset()
+            return
+        self.coarse_state = coarse_state / total
+
+        if self.window is not None:
+            self.window.update(color_code, move_code)
+            window_mass = np.sum(self.coarse_state[self.window.blocks])
+            if self.window.lost or window_mass < self.min_window_mass:
+                # The robot was not where the window thought, so search the whole maze again
+                self.window = None
+            else:
+                # The exact belief replaces the coarse one inside the window
+                self.coarse_state[self.window.blocks] = window_mass * self.window.block_masses()
+
+        self._select_window()
+
+    # Same as the predictor's solve_for_probability_distribution, starting from the beginning
+    def solve_for_probability_distribution(self, sensor_readings, movements=None):
+        if movements:
+            if len(sensor_readings) != len(movements):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+        self.reset()
+        for i in range(len(sensor_readings)):
+            if movements:
+                self.update(sensor_readings[i], movements[i])
+            else:
+                self.update(sensor_readings[i])
+
+        return self.belief()
+
+    # Returns the probability distribution over the whole maze, in the layout of the maze map. Inside the window
+    #   this is the exact belief, and everywhere else each block's probability is spread evenly over its floor
+    def belief(self):
+        floor = self.colored_maze.floor_mask
+        spread = self.coarse_state / np.maximum(self.block_floor_sizes, 1)
+        belief = np.where(floor, spread[self.space_blocks], 0.0)
+        if self.window is not None:
+            belief[self.window.spaces] = np.sum(self.coarse_state[self.window.blocks]) * self.window.belief()
+        return belief
+
+    # The fraction of the maze that the exact filter is running on (0 when there is no window)
+    def window_fraction(self):
+        if self.window is None:
+            return 0.0
+        return len(self.window.spaces) / (self.colored_maze.width * self.colored_maze.height)
+
+    @staticmethod
+    # Adds up the coarse entries for moves from floor spaces in `blocks` into `target_blocks`
+    def _coarse_entries(blocks, target_blocks, weight, sizes):
+        num_blocks = len(sizes)
+        keys, key_ids = np.unique(blocks * num_blocks + target_blocks, return_inverse=True)
+        values = np.bincount(key_ids.ravel(), weights=weight / sizes[target_blocks])
+        rows, columns = np.divmod(keys, num_blocks)
+        return rows, columns, values
+
+    # Find the smallest window that holds window_mass of the coarse probability, and start (or move) the fine filter
+    #   there if it is small enough and is either sharper than the current window or not covered by it. Without one,
+    #   the exact search runs on the whole maze
+    def _select_window(self):
+        order = np.argsort(self.coarse_state)[::-1]
+        num_likely = int(np.searchsorted(np.cumsum(self.coarse_state[order]), self.window_mass)) + 1
+        block_rows, block_columns = np.divmod(order[:num_likely], self.block_columns)
+        block_box = (max(block_rows.min() - self.margin, 0), min(block_rows.max() + self.margin + 1, self.block_rows),
+                     max(block_columns.min() - self.margin, 0),
+                     min(block_columns.max() + self.margin + 1, self.block_columns))
+        box = (block_box[0] * self.block_size, min(block_box[1] * self.block_size, self.colored_maze.height),
+               block_box[2] * self.block_size, min(block_box[3] * self.block_size, self.colored_maze.width))
+        num_spaces = (box[1] - box[0]) * (box[3] - box[2])
+        if num_spaces > self.max_window_spaces:
+            if self.window is not None or not self.exact_search:
+                return
+            box = (0, self.colored_maze.height, 0, self.colored_maze.width)
+            num_spaces = self.colored_maze.height * self.colored_maze.width
+
+        if self.window is not None:
+            inside = self.window.box[0] <= box[0] and box[1] <= self.window.box[1] and \
+                self.window.box[2] <= box[2] and box[3] <= self.window.box[3]
+            if inside and 2 * num_spaces > len(self.window.spaces):
+                return
+
+        # The new window starts from the current belief over its spaces
+        belief = self.belief()
+        self.window = _Window(self, box)
+        self.window.set_belief(belief[self.window.spaces])
+
+
+# The exact filter running on a rectangle of the maze (in whole blocks), with a ring of one space around it. The ring
+#   catches the probability that moves out of the window, which is then dropped, and is always empty at the start of
+#   a step so nothing moves back in from it
+class _Window:
+    def __init__(self, multi_filter, box):
+        colored_maze = multi_filter.colored_maze
+        self.box = box
+        top, bottom, left, right = box
+        ring_box = (max(top - 1, 0), min(bottom + 1, colored_maze.height),
+                    max(left - 1, 0), min(right + 1, colored_maze.width))
+        codes_grid = np.reshape(colored_maze.color_codes, (colored_maze.height, colored_maze.width))
+        sub_codes = codes_grid[ring_box[0]:ring_box[1], ring_box[2]:ring_box[3]]
+        sub_maze = ColoredMaze.from_codes(sub_codes.ravel(), sub_codes.shape[1], sub_codes.shape[0])
+        self.predictor = FilteringMazePredictor(sub_maze, multi_filter.backend)
+
+        # Which spaces of the window's own maze are inside the window (not the ring), and their indices in the maze
+        inside = np.zeros(sub_codes.shape, dtype=bool)
+        inside[top - ring_box[0]:bottom - ring_box[0], left - ring_box[2]:right - ring_box[2]] = True
+        self.inside = inside.ravel()
+        rows, columns = np.divmod(np.flatnonzero(self.inside), sub_codes.shape[1])
+        self.spaces = (rows + ring_box[0]) * colored_maze.width + columns + ring_box[2]
+
+        # The window's blocks, and the block of every space inside it numbered among them
+        space_blocks = multi_filter.space_blocks[self.spaces]
+        self.blocks, self.space_block_ids = np.unique(space_blocks, return_inverse=True)
+        self.space_block_ids = self.space_block_ids.ravel()
+        self.state = None
+        self.lost = False
+
+    # Start from the given (not necessarily normalized) belief over the spaces inside the window
+    def set_belief(self, belief):
+        self.state = np.zeros(len(self.inside))
+        total = np.sum(belief)
+        if total > 0:
+            self.state[self.inside] = belief / total
+        else:
+            self.state[self.inside] = self.predictor.colored_maze.floor_mask[self.inside]
+            self.state *= 1 / np.sum(self.state)
+
+    # One step of the exact filter on the window
+    def update(self, color_code, move_code):
+        if move_code == FilteringMazePredictor.RANDOM_MOVE:
+            predicted = self.predictor.prediction_step(self.state)
+        else:
+            predicted = self.state[self.predictor.direction_target_table[move_code]]
+        # Drop what moved into the ring
+        predicted[~self.inside] = 0
+        predicted *= self.predictor.likelihood_table[color_code]
+
+        total = np.sum(predicted)
+        if not (0 < total < np.inf):
+            self.lost = True
+            return
+        self.state = predicted / total
+
+    # The belief over the spaces inside the window, in the order of spaces
+    def belief(self):
+        return self.state[self.inside]
+
+    # The probability of each of the window's blocks, in the order of blocks
+    def block_masses(self):
+        return np.bincount(self.space_block_ids, weights=self.belief(), minlength=len(self.blocks))
+
+
+if __name__ == "__main__":
+    multi_filter = MultiResolutionFilter(ColoredMaze("./mazes/maze16x16"), block_size=4)
+    readings = ["g", "g", "r", "y", "b", "b", "b", "b", "r", "r", "g", "g"]
+    multi_filter.colored_maze.illustrate_probabilities(multi_filter.solve_for_probability_distribution(readings))
+    print(f"Fine window covers {multi_filter.window_fraction():.2f} of the maze")
@@ -0,0 +1,190 @@
+import sys
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Runs a FilteringMazePredictor's filter on several cores by splitting the maze into bands of rows, one per worker
+#   process. This is the same matrix-free (stencil) step as the predictor's "stencil" backend, so it works on mazes
+#   far too big for a movement matrix.
+# The belief lives in two (h, w) grids in shared memory: the current one and the next one. For every step, each
+#   worker reads its band of the current grid plus one halo row above and below it (which belong to the neighbouring
+#   bands, and are all that is needed for 4-neighbour moves), writes its band of the next grid, and sends back the sum
+#   of its band. The main process adds those partial sums up for the normalization, and the workers apply it at the
+#   start of the next step, so each step is a single round trip to the workers.
+class ParallelBandFilter:
+    def __init__(self, predictor, num_workers=None):
+        self.predictor = predictor
+        colored_maze = predictor.colored_maze
+        self.height = colored_maze.height
+        self.width = colored_maze.width
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        num_workers = max(1, min(num_workers, self.height))
+
+        # Double buffered belief grids in shared memory
+        grid_bytes = self.height * self.width * np.dtype(float).itemsize
+        self.shared_grids = [shared_memory.SharedMemory(create=True, size=max(grid_bytes, 1)) for _ in range(2)]
+        self.grids = [np.ndarray((self.height, self.width), dtype=float, buffer=shared.buf)
+                      for shared in self.shared_grids]
+        self.current = 0
+        self.scale = 1.0
+
+        # Everything a worker needs about the maze, cut down to its band of rows
+        floor_grid = colored_maze.get_floor_grid()
+        open_direction_grids = [colored_maze.get_open_direction_grid(direction)
+                                for direction in predictor.DIRECTIONS]
+        likelihood_grids = np.reshape(predictor.likelihood_table, (-1, self.height, self.width))
+
+        self.bands = []
+        self.connections = []
+        self.workers = []
+        band_edges = np.linspace(0, self.height, num_workers + 1).astype(int)
+        for start, end in zip(band_edges[:-1], band_edges[1:]):
+            connection, worker_connection = multiprocessing.Pipe()
+            band = {
+                "start": int(start),
+                "end": int(end),
+                "floor": floor_grid[start:end],
+                "open": [open_grid[start:end] for open_grid in open_direction_grids],
+                "likelihoods": likelihood_grids[:, start:end],
+            }
+            worker = multiprocessing.Process(target=_band_worker, daemon=True,
+                                             args=(worker_connection, [shared.name for shared in self.shared_grids],
+                                                   (self.height, self.width), band, predictor.DIRECTIONS))
+            worker.start()
+            self.bands.append((int(start), int(end)))
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+        self.reset()
+
+    # Go back to the predictor's initial state
+    def reset(self):
+        self.current = 0
+        self.scale = 1.0
+        self.grids[self.current][:] = np.reshape(self.predictor.initial_state, (self.height, self.width))
+
+    # Take one new sensor reading (and optionally the move that was attempted before it) into account
+    def update(self, sensor_data, move=None):
+        color_code = int(self.predictor.encode_readings([sensor_data])[0])
+        move_code = self.predictor.RANDOM_MOVE
+        if move:
+            move_code = int(self.predictor.encode_moves([move])[0])
+
+        for connection in self.connections:
+            connection.send(("step", self.current, color_code, move_code, self.scale))
+        total = sum(connection.recv() for connection in self.connections)
+
+        self.current = 1 - self.current
+        if not (0 < total < np.inf):
+            # Same as the predictor's get_next_state_scaled: start again from the initial state with this reading.
+            #   The workers are waiting for the next step, so the main process can write the grid itself
+            print("Sensor reading is impossible from this state", file=sys.stderr)
+            restart = self.predictor.initial_state * self.predictor.likelihood_table[color_code]
+            self.grids[self.current][:] = np.reshape(restart, (self.height, self.width))
+            total = np.sum(restart)
+        self.scale = 1 / total
+
+    # Same as the predictor's solve_for_probability_distribution, starting from the initial state
+    def solve_for_probability_distribution(self, sensor_readings, movements=None):
+        if movements:
+            if len(sensor_readings) != len(movements):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+        self.reset()
+        for i in range(len(sensor_readings)):
+            if movements:
+                self.update(sensor_readings[i], movements[i])
+            else:
+                self.update(sensor_readings[i])
+
+        return self.belief()
+
+    # Returns the current probability distribution in the same layout as the predictor's states
+    def belief(self):
+        return (self.grids[self.current] * self.scale).ravel()
+
+    # Stop the workers and free the shared memory
+    def close(self):
+        for connection in self.connections:
+            connection.send(("stop",))
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+        self.grids = []
+        for shared in self.shared_grids:
+            shared.close()
+            shared.unlink()
+        self.shared_grids = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# The loop run by each worker process. It owns rows [start, end) of the grids
+def _band_worker(connection, shared_names, shape, band, directions):
+    try:
+        # Only the main process should unlink the memory when it is done (Python 3.13+)
+        shared_grids = [shared_memory.SharedMemory(name=name, track=False) for name in shared_names]
+    except TypeError:
+        shared_grids = [shared_memory.SharedMemory(name=name) for name in shared_names]
+    grids = [np.ndarray(shape, dtype=float, buffer=shared.buf) for shared in shared_grids]
+    start = band["start"]
+    end = band["end"]
+    floor = band["floor"]
+    open_grids = band["open"]
+    likelihoods = band["likelihoods"]
+    random_move = len(directions)
+    # np.roll shifts for the East and West neighbours, which stay inside the band
+    row_shifts = {"E": -1, "W": 1}
+
+    while True:
+        message = connection.recv()
+        if message[0] == "stop":
+            break
+        _, current, color_code, move_code, scale = message
+        grid = grids[current]
+
+        # The band with one halo row above and below it (zeros past the edges of the maze, where the open masks make
+        #   sure they are never used)
+        extended = np.zeros((end - start + 2, shape[1]))
+        extended[max(0, 1 - start):end - start + 1 + min(1, shape[0] - end)] = \
+            grid[max(0, start - 1):min(shape[0], end + 1)]
+        own_rows = extended[1:-1]
+
+        # The value of each space's neighbour in each direction. Row 0 of the maze is the top, so North is the row above
+        neighbours = {"N": extended[:-2], "S": extended[2:]}
+        for direction, shift in row_shifts.items():
+            neighbours[direction] = np.roll(own_rows, shift, axis=1)
+
+        if move_code == random_move:
+            predicted = np.zeros(own_rows.shape)
+            for i, direction in enumerate(directions):
+                predicted += np.where(open_grids[i], neighbours[direction], own_rows)
+            predicted = 0.25 * predicted * floor
+        else:
+            predicted = np.where(open_grids[move_code], neighbours[directions[move_code]], own_rows)
+
+        predicted *= likelihoods[color_code]
+        predicted *= scale
+        grids[1 - current][start:end] = predicted
+        connection.send(float(np.sum(predicted)))
+
+    for shared in shared_grids:
+        shared.close()
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+    from FilteringMazePredictor import FilteringMazePredictor
+
+    Fil = FilteringMazePredictor(ColoredMaze("./mazes/maze16x16"), backend="stencil")
+    with ParallelBandFilter(Fil, num_workers=4) as band_filter:
+        readings = ["g", "g", "r", "y", "b", "b", "b", "b"]
+        Fil.colored_maze.illustrate_probabilities(band_filter.solve_for_probability_distribution(readings))
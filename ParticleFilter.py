@@ -0,0 +1,145 @@
+import sys
+
+import numpy as np
+
+from FilteringMazePredictor import FilteringMazePredictor
+
+
+# An approximate version of FilteringMazePredictor for mazes that are too big to keep an exact probability for every
+#   location. Instead, a fixed number of particles (guesses of where the robot is) are moved around the maze with the
+#   same blind movement rules, and weighted by how well the color under them matches the sensor reading.
+# The only per-location work is done once when the filter is made (the movement table and the colors of the maze).
+#   Every step after that is O(number of particles), no matter how big the maze is.
+# When the weights get too uneven, the particles are resampled, so that particles that do not match the readings get
+#   replaced by copies of ones that do.
+class ParticleFilter:
+    def __init__(self, colored_maze, num_particles=1000, resample_threshold=0.5, seed=None):
+        self.colored_maze = colored_maze
+        self.num_particles = num_particles
+        # Resample when the effective number of particles drops below this fraction of num_particles
+        self.resample_threshold = resample_threshold
+        self.rng = np.random.default_rng(seed)
+
+        # Row i is blind_movements_indices(i), so a random move picks one of the 4 columns
+        self.movements_table = colored_maze.get_blind_movements_table()
+
+        # The index into COLORS of the color of every location (WALL_CODE for walls), and the floor locations
+        #   particles can start on
+        self.location_colors = colored_maze.color_codes
+        self.floor_indices = np.flatnonzero(colored_maze.floor_mask)
+
+        # The exact filter's known move gathers every location's probability from its target, so the probability at
+        #   location j ends up on every floor location whose target is j (walls get some too, but the sensor update
+        #   always wipes it out), and is lost if there are none. For every direction, those sources are kept grouped
+        #   by target: the sources of j are move_sources[d][move_starts[d][j]:move_starts[d][j] + move_counts[d][j]]
+        self.move_sources = []
+        self.move_starts = []
+        self.move_counts = []
+        for direction in FilteringMazePredictor.DIRECTIONS:
+            targets = colored_maze.get_direction_targets(direction)[self.floor_indices]
+            counts = np.bincount(targets, minlength=len(self.location_colors))
+            self.move_sources.append(self.floor_indices[np.argsort(targets, kind="stable")])
+            self.move_starts.append(np.cumsum(counts) - counts)
+            self.move_counts.append(counts)
+
+        self.particles = None
+        self.weights = None
+        self.reset()
+
+    # Spread the particles evenly at random over the floor spaces, like the predictor's initial state
+    def reset(self):
+        self.particles = self.rng.choice(self.floor_indices, size=self.num_particles)
+        self.weights = np.full(self.num_particles, 1 / self.num_particles)
+
+    # Move the particles, weight them by the sensor reading, and resample them if needed
+    # Parameter: A char in {'r', 'g', 'b', 'y'} as the sensor reading (or its encoded index), or None for no reading
+    # Optional Parameter: The move in {'N', 'E', 'S', 'W'} that the robot tried to make
+    def update(self, sensor_data, move=None):
+        color_code = FilteringMazePredictor.encode_readings([sensor_data])[0]
+        if move:
+            # Same as the exact filter: the probability at location j is gathered by every floor location whose target
+            #   is j, so a particle at j is moved to each of them with the same weight (which multiplies its weight by
+            #   how many there are), and is gone if there are none. Moving it to just one of them at random would lose
+            #   the others for good once the particles are resampled
+            move_code = FilteringMazePredictor.encode_moves([move])[0]
+            counts = self.move_counts[move_code][self.particles]
+            parents = np.repeat(np.arange(len(self.particles)), counts)
+            offsets = np.arange(len(parents)) - np.repeat(np.cumsum(counts) - counts, counts)
+            starts = self.move_starts[move_code][self.particles[parents]]
+            self.particles = self.move_sources[move_code][starts + offsets]
+            self.weights = self.weights[parents]
+        else:
+            # The robot is blind, so each particle tries one of the 4 directions at random
+            self.particles = self.movements_table[self.particles, self.rng.integers(0, 4, size=len(self.particles))]
+
+        # Without a reading (None) the particles just move
+        if color_code != FilteringMazePredictor.NO_READING:
+            self.weights *= np.where(self.location_colors[self.particles] == color_code,
+                                     self.colored_maze.SENSOR_ACCURACY, self.colored_maze.SENSOR_ERROR)
+        total = np.sum(self.weights)
+        if not (0 < total < np.inf):
+            print("Sensor reading is impossible from every particle", file=sys.stderr)
+            self.reset()
+            return
+        self.weights *= 1 / total
+
+        # Known moves can also leave more particles than num_particles
+        if len(self.particles) > 2 * self.num_particles or \
+                self.effective_sample_size() < self.resample_threshold * self.num_particles:
+            self.resample()
+
+    # Same as the predictor's solve_for_probability_distribution, starting from a fresh set of particles
+    # Returns the dense estimate of the probability distribution (see belief_estimate)
+    def solve_for_probability_distribution(self, sensor_readings, movements=None):
+        if movements:
+            if len(sensor_readings) != len(movements):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+        self.reset()
+        for i in range(len(sensor_readings)):
+            if movements:
+                self.update(sensor_readings[i], movements[i])
+            else:
+                self.update(sensor_readings[i])
+
+        return self.belief_estimate()
+
+    # How many particles the weights are effectively worth, between 1 (one particle has all the weight) and
+    #   num_particles (all weights are equal)
+    def effective_sample_size(self):
+        return 1 / np.sum(self.weights ** 2)
+
+    # Resampling that keeps every location a particle is on. The weights of the particles on each location are added
+    #   up, and each location gets round(num_particles * weight) particles (at least 1) that share its weight
+    # Plain resampling drops the locations with less than 1 / num_particles of the weight. Known moves never spread the
+    #   probability out again, so those locations could never come back, even once later readings make them the most
+    #   likely ones
+    def resample(self):
+        locations, location_indices = np.unique(self.particles, return_inverse=True)
+        location_weights = np.bincount(location_indices, weights=self.weights, minlength=len(locations))
+        copies = np.maximum(1, np.round(self.num_particles * location_weights)).astype(np.intp)
+        self.particles = np.repeat(locations, copies)
+        self.weights = np.repeat(location_weights / copies, copies)
+
+    # Returns a probability distribution over every location in the maze, in the same layout as the predictor's
+    #   states, by adding up the weights of the particles at each location
+    def belief_estimate(self):
+        return np.bincount(self.particles, weights=self.weights, minlength=len(self.location_colors))
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+
+    maze = ColoredMaze("./mazes/maze1")
+    readings = ["r", "g", "r", "g", "b"]
+    particle_filter = ParticleFilter(maze, num_particles=10000, seed=0)
+    print("Particle filter estimate:")
+    maze.illustrate_probabilities(particle_filter.solve_for_probability_distribution(readings))
+    print("Exact filter:")
+    maze.illustrate_probabilities(FilteringMazePredictor(maze).solve_for_probability_distribution(readings))
+
+    moves = ["N", "E", "N", "W", "S"]
+    print("Particle filter estimate with known moves:")
+    maze.illustrate_probabilities(particle_filter.solve_for_probability_distribution(readings, moves))
+    print("Exact filter with known moves:")
+    maze.illustrate_probabilities(FilteringMazePredictor(maze).solve_for_probability_distribution(readings, moves))
@@ -0,0 +1,134 @@
+from collections import OrderedDict
+
+
+# One step of a sequence in the trie. The key is the (reading, move) pair that led here from the parent, and the
+#   belief (if cached) is the probability distribution after all the steps from the root down to this node
+class _TrieNode:
+    __slots__ = ("parent", "key", "children", "belief")
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+        self.children = dict()
+        self.belief = None
+
+
+# Caches the probability distributions part way through sequences of sensor readings (and moves), so a new query
+#   that starts with the same readings as an earlier one can pick up from where they split instead of starting again
+#   from the predictor's initial state.
+# The sequences are stored in a trie, with one node per step. Every `store_every` steps (and at the end of every
+#   query) the belief is kept on the node. At most `max_entries` beliefs are kept, and the least recently used ones
+#   are evicted first, along with any part of the trie that no longer leads to a cached belief.
+class PrefixBeliefCache:
+    def __init__(self, predictor, max_entries=1000, store_every=16):
+        self.predictor = predictor
+        self.max_entries = max_entries
+        self.store_every = store_every
+
+        self.root = _TrieNode(None, None)
+        self.cached_nodes = OrderedDict()
+
+        self.queries = 0
+        self.hits = 0
+        self.steps_reused = 0
+        self.steps_computed = 0
+
+    # Same as the predictor's solve_for_probability_distribution, resuming from the longest cached prefix
+    def solve_for_probability_distribution(self, sensor_readings, movements=None):
+        encoded = self.predictor.encode_sequence(sensor_readings, movements)
+        if encoded is None:
+            return None
+        steps = list(zip(encoded[0].tolist(), encoded[1].tolist()))
+        self.queries += 1
+
+        # Walk down the trie as far as the sequence has been seen, remembering the deepest cached belief
+        node = self.root
+        resume_node = None
+        resume_step = 0
+        for t, step in enumerate(steps):
+            if step not in node.children:
+                break
+            node = node.children[step]
+            if node.belief is not None:
+                resume_node = node
+                resume_step = t + 1
+
+        if resume_node is None:
+            node = self.root
+            current_state = self.predictor.initial_state
+        else:
+            self.hits += 1
+            self.steps_reused += resume_step
+            self.cached_nodes.move_to_end(id(resume_node))
+            node = resume_node
+            # Copied so that changes made by the caller do not end up in the cache
+            current_state = resume_node.belief.copy()
+
+        for t in range(resume_step, len(steps)):
+            current_state = self.predictor.get_next_state_encoded(current_state, *steps[t])
+            self.steps_computed += 1
+
+            if steps[t] not in node.children:
+                node.children[steps[t]] = _TrieNode(node, steps[t])
+            node = node.children[steps[t]]
+            if (t + 1) % self.store_every == 0 or t == len(steps) - 1:
+                self._store(node, current_state)
+
+        return current_state
+
+    # The fraction of queries that could resume from a cached prefix
+    def hit_rate(self):
+        if self.queries == 0:
+            return 0.0
+        return self.hits / self.queries
+
+    # Returns the statistics of the cache, to help choose max_entries and store_every
+    def stats(self):
+        total_steps = self.steps_reused + self.steps_computed
+        return {
+            "queries": self.queries,
+            "hits": self.hits,
+            "hit_rate": self.hit_rate(),
+            "steps_reused": self.steps_reused,
+            "steps_computed": self.steps_computed,
+            "step_reuse_rate": self.steps_reused / total_steps if total_steps > 0 else 0.0,
+            "cached_beliefs": len(self.cached_nodes),
+        }
+
+    # Empty the cache (the statistics are kept)
+    def clear(self):
+        self.root = _TrieNode(None, None)
+        self.cached_nodes.clear()
+
+    # Cache the belief on a node, evicting the least recently used beliefs if there are too many
+    def _store(self, node, belief):
+        if node.belief is None:
+            self.cached_nodes[id(node)] = node
+        else:
+            self.cached_nodes.move_to_end(id(node))
+        # Copied since the same array is handed back to the caller
+        node.belief = belief.copy()
+
+        while len(self.cached_nodes) > self.max_entries:
+            _, evicted = self.cached_nodes.popitem(last=False)
+            evicted.belief = None
+            self._prune(evicted)
+
+    # Remove nodes that no longer lead to any cached belief, going up the trie from the given node
+    def _prune(self, node):
+        while node is not self.root and node.belief is None and not node.children:
+            del node.parent.children[node.key]
+            node = node.parent
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+    from FilteringMazePredictor import FilteringMazePredictor
+
+    Fil = FilteringMazePredictor(ColoredMaze("./mazes/maze8x8"))
+    cache = PrefixBeliefCache(Fil, store_every=4)
+    mission = ["g", "g", "r", "y", "b", "b", "b", "b"]
+    cache.solve_for_probability_distribution(mission + ["g", "g"])
+    cache.solve_for_probability_distribution(mission + ["r"])
+    Fil.colored_maze.illustrate_probabilities(cache.solve_for_probability_distribution(mission))
+    print(cache.stats())
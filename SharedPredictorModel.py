@@ -0,0 +1,115 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ColoredMaze import ColoredMaze
+from FilteringMazePredictor import FilteringMazePredictor
+
+# The name of the maze's space codes in the layout of the shared memory, next to the predictor's model arrays
+MAZE_CODES_NAME = "maze_color_codes"
+
+
+# Shares one built FilteringMazePredictor model between worker processes instead of every worker building its own
+#   copy of the movement matrix, direction targets and color vectors.
+# The main process publishes the predictor's model arrays once into a single block of shared memory. Workers attach
+#   to that block by its descriptor (a small picklable dict) and get a predictor whose arrays are read-only views of
+#   the shared memory, so nothing is copied. Only the beliefs that each worker computes are private to it.
+# The publishing process owns the shared memory and should call unlink() once every worker is done with it.
+class SharedPredictorModel:
+    # Every array starts on a multiple of this many bytes
+    ALIGNMENT = 64
+
+    def __init__(self, shared, descriptor):
+        self.shared = shared
+        self.descriptor = descriptor
+        self.predictor = None
+
+    # Build the predictor's whole model and copy it into a new block of shared memory. Only the arrays the filter
+    #   reads (build_model_arrays) are shared, so direction_matrices is never copied in
+    # The maze's space codes go in the same block, and workers rebuild the maze around them (the floor mask and the
+    #   neighbour table are only built again if a worker needs them)
+    @classmethod
+    def publish(cls, predictor):
+        colored_maze = predictor.colored_maze
+        model_arrays = predictor.build_model_arrays()
+        model_arrays[MAZE_CODES_NAME] = colored_maze.color_codes
+        layout = dict()
+        offset = 0
+        for name, array in model_arrays.items():
+            layout[name] = (offset, array.shape, array.dtype.str)
+            offset += -(-array.nbytes // cls.ALIGNMENT) * cls.ALIGNMENT
+
+        shared = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for name, array in model_arrays.items():
+            start, shape, dtype = layout[name]
+            np.ndarray(shape, dtype=dtype, buffer=shared.buf, offset=start)[...] = array
+
+        descriptor = {
+            "name": shared.name,
+            # Classes pickle by name, so workers rebuild the same kind of predictor (like FloorFilteringMazePredictor)
+            "predictor_class": type(predictor),
+            "backend": predictor.backend,
+            "layout": layout,
+            "width": colored_maze.width,
+            "height": colored_maze.height,
+            "robot_loc": list(colored_maze.robot_loc),
+        }
+        model = cls(shared, descriptor)
+        model.predictor = predictor
+        return model
+
+    # Attach to a published model from another process, given its descriptor
+    @classmethod
+    def attach(cls, descriptor):
+        try:
+            # Only the publisher should unlink the memory when it is done (Python 3.13+)
+            shared = shared_memory.SharedMemory(name=descriptor["name"], track=False)
+        except TypeError:
+            shared = shared_memory.SharedMemory(name=descriptor["name"])
+
+        model_arrays = dict()
+        for name, (start, shape, dtype) in descriptor["layout"].items():
+            array = np.ndarray(shape, dtype=dtype, buffer=shared.buf, offset=start)
+            array.flags.writeable = False
+            model_arrays[name] = array
+
+        colored_maze = ColoredMaze.from_codes(model_arrays.pop(MAZE_CODES_NAME), descriptor["width"],
+                                              descriptor["height"], descriptor["robot_loc"])
+        model = cls(shared, descriptor)
+        model.predictor = descriptor["predictor_class"].from_model_arrays(colored_maze, model_arrays,
+                                                                          descriptor["backend"])
+        return model
+
+    # Stop using the shared memory in this process. Predictors made from it must not be used after this
+    def close(self):
+        self.predictor = None
+        self.shared.close()
+
+    # Free the shared memory once every process has closed it. Only the publisher should do this
+    def unlink(self):
+        self.shared.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == "__main__":
+    import multiprocessing
+
+    def solve_in_worker(descriptor, readings):
+        model = SharedPredictorModel.attach(descriptor)
+        belief = model.predictor.solve_for_probability_distribution(readings)
+        model.close()
+        return belief
+
+    published = SharedPredictorModel.publish(FilteringMazePredictor(ColoredMaze("./mazes/maze8x8"), "sparse"))
+    logs = [["g", "g", "r", "y"], ["b", "b", "b", "b"], ["g", "g", "g", "g"]]
+    with multiprocessing.Pool(3) as pool:
+        beliefs = pool.starmap(solve_in_worker, [(published.descriptor, log) for log in logs])
+    for belief in beliefs:
+        published.predictor.colored_maze.illustrate_probabilities(belief)
+    published.close()
+    published.unlink()
@@ -0,0 +1,168 @@
+import sys
+
+import numpy as np
+
+
+# Runs a FilteringMazePredictor's filter while only keeping track of the locations that still have a meaningful
+#   probability. After a few distinctive readings almost all the probability is on a few locations, so instead of a
+#   vector over the whole maze the tracker keeps the indices and probabilities of those locations (the support), and
+#   only pushes those through the movement structure. Each step then costs about O(support size) instead of O(w * h).
+# Locations below `threshold` (and everything outside the `top_k` most likely locations, if given) are dropped after
+#   every step and the rest is scaled back up to add up to 1. The probability dropped is recorded.
+# When the support gets bigger than `dense_fraction` of the maze, pruning is not worth it any more and the tracker
+#   falls back to the predictor's normal (dense) steps until the probability is concentrated again.
+class SparseBeliefTracker:
+    def __init__(self, predictor, threshold=1e-6, top_k=None, dense_fraction=0.25):
+        self.predictor = predictor
+        self.threshold = threshold
+        self.top_k = top_k
+        self.num_locations = len(predictor.initial_state)
+        self.max_sparse_support = int(dense_fraction * self.num_locations)
+
+        # prediction_step computes predicted[i] = sum over j of matrix[i][j] * state[j]. To push the probability of a
+        #   location j forwards we need column j of each matrix, so they are stored column by column
+        rows, columns = predictor.random_movement_entries()
+        self.random_columns = self._columns(rows, columns, np.full(len(rows), 0.25))
+        self.direction_columns = []
+        for targets in predictor.direction_target_table:
+            self.direction_columns.append(self._columns(np.arange(self.num_locations), targets,
+                                                        np.ones(self.num_locations)))
+
+        self.dense_state = None
+        self.support = None
+        self.support_probabilities = None
+        self.dropped_mass = 0.0
+        self.last_dropped_mass = 0.0
+        self.reset()
+
+    # Go back to the predictor's initial state. It is spread over the whole maze, so this starts out dense
+    def reset(self):
+        self.dense_state = np.array(self.predictor.initial_state, dtype=float)
+        self.support = None
+        self.support_probabilities = None
+        self.dropped_mass = 0.0
+        self.last_dropped_mass = 0.0
+
+    # Whether the belief is currently stored as a sparse support (True) or as a full vector (False)
+    def is_sparse(self):
+        return self.support is not None
+
+    # The number of locations the belief is being tracked on
+    def support_size(self):
+        if self.is_sparse():
+            return len(self.support)
+        return self.num_locations
+
+    # Take one new sensor reading (and optionally the move that was attempted before it) into account
+    # Returns the probability that was dropped by pruning in this step
+    def update(self, sensor_data, move=None):
+        color_code = self.predictor.encode_readings([sensor_data])[0]
+        move_code = self.predictor.RANDOM_MOVE
+        if move:
+            move_code = self.predictor.encode_moves([move])[0]
+
+        self.last_dropped_mass = 0.0
+        if self.is_sparse():
+            self._sparse_step(color_code, move_code)
+        else:
+            self.dense_state = self.predictor.get_next_state_scaled(self.dense_state, color_code, move_code)[0]
+            # Switch to the sparse support once few enough locations are above the threshold
+            if np.count_nonzero(self.dense_state >= self.threshold) <= self.max_sparse_support // 2:
+                support = np.flatnonzero(self.dense_state)
+                self._set_support(support, self.dense_state[support])
+
+        self.dropped_mass += self.last_dropped_mass
+        return self.last_dropped_mass
+
+    # Same as the predictor's solve_for_probability_distribution, starting from the initial state
+    def solve_for_probability_distribution(self, sensor_readings, movements=None):
+        if movements:
+            if len(sensor_readings) != len(movements):
+                print("Movements and sensor readings must be the same length", file=sys.stderr)
+                return None
+        self.reset()
+        for i in range(len(sensor_readings)):
+            if movements:
+                self.update(sensor_readings[i], movements[i])
+            else:
+                self.update(sensor_readings[i])
+
+        return self.belief()
+
+    # Returns the current probability distribution as a full vector, in the same layout as the predictor's states
+    def belief(self):
+        if not self.is_sparse():
+            return self.dense_state
+        state = np.zeros(self.num_locations)
+        state[self.support] = self.support_probabilities
+        return state
+
+    # One filtering step on the sparse support: push the probability of every location in the support through its
+    #   column of the movement matrix, add up where it lands, then apply the sensor reading
+    def _sparse_step(self, color_code, move_code):
+        if move_code == self.predictor.RANDOM_MOVE:
+            column_starts, row_indices, weights = self.random_columns
+        else:
+            column_starts, row_indices, weights = self.direction_columns[move_code]
+
+        starts = column_starts[self.support]
+        counts = column_starts[self.support + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+        rows = row_indices[offsets]
+        contributions = weights[offsets] * np.repeat(self.support_probabilities, counts)
+
+        support, inverse = np.unique(rows, return_inverse=True)
+        probabilities = np.bincount(inverse, weights=contributions) * \
+            self.predictor.likelihood_table[color_code][support]
+
+        total = np.sum(probabilities)
+        if not (0 < total < np.inf):
+            # Everything that was tracked became impossible. Start again from the full initial state
+            self.last_dropped_mass = 1.0
+            self.dense_state = self.predictor.initial_state * self.predictor.likelihood_table[color_code]
+            self.dense_state *= 1 / np.sum(self.dense_state)
+            self.support = None
+            self.support_probabilities = None
+            return
+
+        self._set_support(support, probabilities / total)
+        # Too spread out for the sparse support to help, go back to full vectors
+        if len(self.support) > self.max_sparse_support:
+            self.dense_state = self.belief()
+            self.support = None
+            self.support_probabilities = None
+
+    # Prune the given support down to the locations above the threshold (and in the top k), keep track of the
+    #   probability that was dropped, and scale the rest back up to add up to 1
+    def _set_support(self, support, probabilities):
+        keep = probabilities >= self.threshold
+        if self.top_k is not None and np.count_nonzero(keep) > self.top_k:
+            keep[:] = False
+            keep[np.argpartition(probabilities, -self.top_k)[-self.top_k:]] = True
+
+        kept_mass = np.sum(probabilities[keep])
+        self.last_dropped_mass += np.sum(probabilities) - kept_mass
+        self.support = support[keep]
+        self.support_probabilities = probabilities[keep] / kept_mass
+
+    # Stores a matrix given as (row, column, value) entries column by column: returns (column_starts, row_indices,
+    #   values) where the entries of column j are at column_starts[j]:column_starts[j + 1]
+    def _columns(self, rows, columns, values):
+        order = np.argsort(columns, kind="stable")
+        column_starts = np.zeros(self.num_locations + 1, dtype=np.intp)
+        np.cumsum(np.bincount(columns, minlength=self.num_locations), out=column_starts[1:])
+        return column_starts, rows[order], values[order]
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+    from FilteringMazePredictor import FilteringMazePredictor
+
+    Fil = FilteringMazePredictor(ColoredMaze("./mazes/maze16x16"))
+    tracker = SparseBeliefTracker(Fil, threshold=1e-4)
+    readings = ["g", "g", "r", "y", "b", "b", "b", "b", "r", "r", "g", "y"]
+    moves = ["N", "N", "E", "E", "S", "W", "W", "S", "E", "N", "N", "W"]
+    for i in range(len(readings)):
+        tracker.update(readings[i], moves[i])
+        print(f"Read {readings[i]}: tracking {tracker.support_size()} locations, dropped {tracker.dropped_mass:.6f}")
+    Fil.colored_maze.illustrate_probabilities(tracker.belief())
@@ -0,0 +1,94 @@
+import numpy as np
+
+
+# Finds the single most likely sequence of locations of the robot given its sensor readings (and optionally its
+#   moves), using the same model as a FilteringMazePredictor.
+# This is the max-product version of the filter, done in log space so long sequences do not underflow. Instead of
+#   a full matrix, every location only looks at the (at most 4) locations that its row of the random movement matrix
+#   points to, so each step is O(w * h). The backpointer for a random move is which of those 4 entries was the best,
+#   which fits in 2 bits, so four locations are packed into each byte of the backpointer table. Known moves have
+#   only one possible previous location, so they do not need a backpointer at all.
+class ViterbiDecoder:
+    def __init__(self, predictor):
+        self.predictor = predictor
+
+        # Row i holds the locations that row i of the movement matrix points to, and the log of the matrix entry for
+        #   each of them. Repeated locations (from hitting walls) have their probabilities added together like in the
+        #   matrix. Walls have an empty row in the movement matrix, so they point at themselves with entries of -inf
+        # The rows come from the predictor's own movement entries, so the table is in the predictor's states (e.g. the
+        #   floor ids of a FloorFilteringMazePredictor), like its likelihoods and direction targets
+        rows, cols = predictor.random_movement_entries()
+        order = np.argsort(rows, kind="stable")
+        rows = rows[order]
+        self.movements_table = np.repeat(np.arange(predictor.num_states)[:, np.newaxis], 4, axis=1)
+        self.movements_table[rows[::4]] = np.reshape(cols[order], (-1, 4))
+        repeats = (self.movements_table[:, :, np.newaxis] == self.movements_table[:, np.newaxis, :]).sum(axis=2)
+        floor = np.zeros(predictor.num_states, dtype=bool)
+        floor[rows] = True
+        with np.errstate(divide="ignore"):
+            self.log_movement_weights = np.where(floor[:, np.newaxis], np.log(0.25 * repeats), -np.inf)
+            self.log_likelihood_table = np.log(predictor.likelihood_table)
+            self.log_initial_state = np.log(predictor.initial_state / np.sum(predictor.initial_state))
+
+    # Returns (path, log probability) where path is a numpy array of the most likely state of the predictor (the
+    #   location index, for a FilteringMazePredictor) after each sensor reading, and the log probability is that of
+    #   the path together with the readings
+    # Parameter: A list of chars in {'r', 'g', 'b', 'y'} as sensor readings (or their encoded indices)
+    # Optional Parameter: A list of moves in {'N', 'E', 'S', 'W'} as the moves the robot has taken
+    def decode(self, sensor_readings, movements=None):
+        encoded = self.predictor.encode_sequence(sensor_readings, movements)
+        if encoded is None:
+            return None
+        reading_codes, move_codes = encoded
+        reading_codes = reading_codes.tolist()
+        move_codes = move_codes.tolist()
+        num_steps = len(reading_codes)
+        num_locations = len(self.log_initial_state)
+        if num_steps == 0:
+            return np.zeros(0, dtype=np.intp), 0.0
+
+        # Backpointers for step t are packed 4 per byte, 2 bits each
+        backpointers = np.zeros((num_steps, (num_locations + 3) // 4), dtype=np.uint8)
+        padded_codes = np.zeros(4 * backpointers.shape[1], dtype=np.uint8)
+
+        best_log_probs = self.log_initial_state
+        for t in range(num_steps):
+            if move_codes[t] == self.predictor.RANDOM_MOVE:
+                candidates = best_log_probs[self.movements_table] + self.log_movement_weights
+                best_codes = np.argmax(candidates, axis=1)
+                best_log_probs = np.take_along_axis(candidates, best_codes[:, np.newaxis], axis=1)[:, 0]
+
+                padded_codes[:num_locations] = best_codes
+                quads = padded_codes.reshape(-1, 4)
+                backpointers[t] = quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)
+            else:
+                best_log_probs = best_log_probs[self.predictor.direction_target_table[move_codes[t]]]
+
+            best_log_probs = best_log_probs + self.log_likelihood_table[reading_codes[t]]
+
+        # Follow the backpointers from the most likely final location
+        path = np.zeros(num_steps, dtype=np.intp)
+        path[-1] = np.argmax(best_log_probs)
+        for t in range(num_steps - 1, 0, -1):
+            path[t - 1] = self._previous_location(path[t], t, move_codes[t], backpointers)
+
+        return path, float(best_log_probs[path[-1]])
+
+    # The location before `location` on the best path, using the move or the packed backpointer of step t
+    def _previous_location(self, location, t, move_code, backpointers):
+        if move_code != self.predictor.RANDOM_MOVE:
+            return self.predictor.direction_target_table[move_code][location]
+        code = (backpointers[t][location // 4] >> (2 * (location % 4))) & 3
+        return self.movements_table[location][code]
+
+
+if __name__ == "__main__":
+    from ColoredMaze import ColoredMaze
+    from FilteringMazePredictor import FilteringMazePredictor
+
+    maze = ColoredMaze("./mazes/maze1")
+    decoder = ViterbiDecoder(FilteringMazePredictor(maze))
+    best_path, log_prob = decoder.decode(["r", "g", "r", "g", "b"])
+    print("Most likely path:", [(int(index % maze.width), int(maze.height - index // maze.width - 1))
+                                for index in best_path])
+    print("Log probability:", log_prob)
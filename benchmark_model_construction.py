@@ -0,0 +1,54 @@
+import os
+import random
+import tempfile
+import time
+
+from ColoredMaze import ColoredMaze
+from FilteringMazePredictor import FilteringMazePredictor
+
+# Times how long it takes to build the filter's model for random mazes of increasing size, before any sensor
+#   readings are processed. The dense backend is only timed on the smaller mazes, since its (w * h, w * h) matrices
+#   do not fit in memory for the larger ones
+
+sizes = [16, 32, 64, 128, 256, 512]
+largest_dense_size = 64
+wall_chance = 0.2
+
+
+# Writes a random square maze to a file in the same format as the ones in ./mazes
+def write_random_maze(file_name, size):
+    with open(file_name, "w") as f:
+        for _ in range(size):
+            f.write("".join(random.choice("rgby") if random.random() >= wall_chance else "#" for _ in range(size)))
+            f.write("\n")
+
+
+def time_call(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+random.seed(0)
+with tempfile.TemporaryDirectory() as maze_dir:
+    columns = ["load", "colors", "targets", "blind", "dense", "sparse", "stencil"]
+    print(f"{'size':>6} " + " ".join(f"{column:>8}" for column in columns))
+    for size in sizes:
+        maze_file = os.path.join(maze_dir, f"maze{size}x{size}")
+        write_random_maze(maze_file, size)
+
+        maze, load_time = time_call(lambda: ColoredMaze(maze_file))
+        _, colors_time = time_call(lambda: [maze.get_color_vector(color) for color in "rgby"])
+        _, targets_time = time_call(lambda: [maze.get_direction_targets(direction) for direction in "NESW"])
+        _, blind_time = time_call(maze.get_blind_movements_table)
+
+        backend_times = []
+        for backend in ["dense", "sparse", "stencil"]:
+            if backend == "dense" and size > largest_dense_size:
+                backend_times.append("-")
+                continue
+            _, backend_time = time_call(lambda: FilteringMazePredictor(maze, backend).warm())
+            backend_times.append(f"{backend_time:.4f}")
+
+        print(f"{size:>6} {load_time:>8.4f} {colors_time:>8.4f} {targets_time:>8.4f} {blind_time:>8.4f} "
+              + " ".join(f"{backend_time:>8}" for backend_time in backend_times))
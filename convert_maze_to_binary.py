@@ -0,0 +1,13 @@
+import sys
+
+from ColoredMaze import ColoredMaze
+
+# Converts a text maze file (like the ones in ./mazes) into the binary maze format, which ColoredMaze opens memory
+#   mapped instead of reading the whole file. The text file is streamed, so it does not need to fit in memory
+# Usage: python convert_maze_to_binary.py <text maze file> <binary maze file>
+
+if len(sys.argv) != 3:
+    print("Usage: python convert_maze_to_binary.py <text maze file> <binary maze file>", file=sys.stderr)
+    sys.exit(1)
+
+ColoredMaze.convert_text_to_binary(sys.argv[1], sys.argv[2])
@@ -1,7 +1,8 @@
 from MazeTile import MazeTile
 from cs1lib import *
 from ColoredMaze import ColoredMaze
-from FilteringMazePredictor import FilteringMazePredictor
+from FilteringSession import FilteringSession
+from ModelCache import ModelCache
 
 # Author: Ben Williams '25
 # Date: November 1st, 2023
@@ -29,20 +30,25 @@ maze_list = ["maze4x4", "maze1", "quadrants", "separatedQuadrants", "disconnecte
 # We will swap into the first maze
 current_maze = -1
 
+# Built filtering models are saved on disk, so swapping back to a maze does not build them again
+model_cache = ModelCache()
+
 # Initializing so that they are global variables
 colored_maze = ColoredMaze(maze_folder + maze_list[current_maze])
-Fil = FilteringMazePredictor(colored_maze)
+Fil = model_cache.load_predictor(colored_maze)
+session = FilteringSession(Fil)
 colored_maze.randomize_robot_location()
 
 # Initial probability distribution is equal probability for each square
-prob_dist = Fil.initial_state
-directions = []
-colors_sensed = []
+prob_dist = session.belief
+# The move waiting to be made (None once it has been made) and the color sensed after the last move
+pending_move = None
+last_color_sensed = None
 
 
 # Used by the cs1lib start graphics
 def main():
-    global start_program, made_move, cleared, prob_dist, changed_robot_knows_moves
+    global start_program, made_move, cleared, prob_dist, changed_robot_knows_moves, pending_move, last_color_sensed
 
     # Only run at the start of the program
     if start_program or cleared:
@@ -75,14 +81,15 @@ def main():
     # If we have made a move (or are beginning the gui and want to draw the maze)
     if made_move:
         # Attempt the move and get the new probabilities with the new sensor reading
-        if len(directions) > 0:
-            colored_maze.attempt_robot_move(directions[len(directions) - 1])
-            sensor_reading = colored_maze.get_color_faulty(colored_maze.robot_loc[0], colored_maze.robot_loc[1])
-            colors_sensed.append(sensor_reading)
+        if pending_move is not None:
+            colored_maze.attempt_robot_move(pending_move)
+            last_color_sensed = colored_maze.get_color_faulty(colored_maze.robot_loc[0], colored_maze.robot_loc[1])
+            # Only the newest reading needs to be filtered, the session keeps the belief from the previous ones
             if robot_knows_moves:
-                prob_dist = Fil.solve_for_probability_distribution(colors_sensed, directions)
+                prob_dist = session.update(last_color_sensed, pending_move)
             else:
-                prob_dist = Fil.solve_for_probability_distribution(colors_sensed)
+                prob_dist = session.update(last_color_sensed)
+            pending_move = None
 
         # Draw all the maze tiles
         for tile in maze_tiles:
@@ -92,7 +99,7 @@ def main():
             tile.draw(window_height, prob_string)
 
         # Show the last color sensed and the actual robot location
-        if len(colors_sensed) > 0:
+        if last_color_sensed is not None:
             # The convoluted way to reset the text without clearing everything
             set_fill_color(0, 0, 0)
             set_stroke_color(0, 0, 0)
@@ -103,9 +110,9 @@ def main():
 
             # Show which color was sensed
             set_font_size(16)
-            color_text = "Last color sensed: " + colors_sensed[len(colors_sensed) - 1]
+            color_text = "Last color sensed: " + last_color_sensed
             actual_color = colored_maze.get_color(colored_maze.robot_loc[0], colored_maze.robot_loc[1])
-            color_text += " accurately" if colors_sensed[len(colors_sensed) - 1] == actual_color else " inaccurately"
+            color_text += " accurately" if last_color_sensed == actual_color else " inaccurately"
             draw_text(color_text, 9 * window_width / 10 - (4 * len(color_text)), window_height / 20)
 
             robot_loc_text = "Actual robot location: (" + str(colored_maze.robot_loc[0]) + ", " + str(colored_maze.robot_loc[1]) + ")"
@@ -133,14 +140,16 @@ def probability_string(probability):
 
 # Switches to the next maze and resets all the maze-related sensors
 def swap_maze():
-    global current_maze, colored_maze, Fil, prob_dist, directions, colors_sensed, maze_tiles, maze_start_x
+    global current_maze, colored_maze, Fil, session, prob_dist, maze_tiles, maze_start_x
+    global pending_move, last_color_sensed
     current_maze = (current_maze + 1) % len(maze_list)
     colored_maze = ColoredMaze(maze_folder + maze_list[current_maze])
     colored_maze.randomize_robot_location()
-    Fil = FilteringMazePredictor(colored_maze)
-    prob_dist = Fil.initial_state
-    directions = []
-    colors_sensed = []
+    Fil = model_cache.load_predictor(colored_maze)
+    session = FilteringSession(Fil)
+    prob_dist = session.belief
+    pending_move = None
+    last_color_sensed = None
 
     # Finding the right place to put the maze so that it is centered
     tile_size = window_height / max(colored_maze.height, colored_maze.width) * 0.8
@@ -160,22 +169,22 @@ def swap_maze():
 
 
 def key_pressed(key):
-    global made_move, robot_knows_moves, changed_robot_knows_moves, start_program
+    global made_move, robot_knows_moves, changed_robot_knows_moves, start_program, pending_move
     # To prevent an error where you press two keys at the same time
-    if len(directions) > len(colors_sensed):
+    if pending_move is not None:
         return
 
     if key == "w":
-        directions.append("N")
+        pending_move = "N"
         made_move = True
     if key == "a":
-        directions.append("W")
+        pending_move = "W"
         made_move = True
     if key == "s":
-        directions.append("S")
+        pending_move = "S"
         made_move = True
     if key == "d":
-        directions.append("E")
+        pending_move = "E"
         made_move = True
     if key == "k":
         robot_knows_moves = not robot_knows_moves
@@ -0,0 +1,389 @@
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+from ColoredMaze import ColoredMaze
+from ComponentFilter import ComponentFilter
+from FilteringMazePredictor import FilteringMazePredictor
+from FilteringSession import FilteringSession
+from FloorFilteringMazePredictor import FloorFilteringMazePredictor
+from FusedOperatorCache import FusedOperatorCache
+from ForwardBackwardSmoother import ForwardBackwardSmoother
+from LumpedFilter import LumpedFilter
+from ModelCache import ModelCache
+from MultiResolutionFilter import MultiResolutionFilter
+from ParallelBandFilter import ParallelBandFilter
+from ParticleFilter import ParticleFilter
+from PrefixBeliefCache import PrefixBeliefCache
+from SharedPredictorModel import SharedPredictorModel
+from SparseBeliefTracker import SparseBeliefTracker
+from ViterbiDecoder import ViterbiDecoder
+
+# Checks that every faster way of filtering gives the same results as the plain dense filter on the mazes in ./mazes
+#   (backends, encoded and batched solvers, sessions, caches, the floor-only, component, lumped and multi-resolution
+#   filters...), and that the dense filter itself matches brute force versions that multiply by the full matrices
+#   built straight from the maze. Prints every check that fails and exits with an error if there were any
+
+maze_folder = "./mazes/"
+num_sequences = 4
+sequence_length = 20
+dropout_length = 500
+tolerance = 1e-10
+# The particle filter is only an estimate, so on average over a maze's cases it only has to be this close with this
+#   many particles (unlikely readings can leave it well off on a single one)
+num_particles = 100000
+particle_tolerance = 0.1
+
+random.seed(0)
+failures = []
+
+
+# Record a failed check if the two beliefs are further apart than the tolerance (in total variation)
+def check(name, belief, expected, allowed_error=tolerance):
+    error = 0.5 * np.sum(np.abs(np.asarray(belief) - np.asarray(expected)))
+    if not error <= allowed_error:
+        failures.append(name)
+        print(f"FAILED {name}: off by {error}")
+
+
+# The full (w * h, w * h) movement matrix of every step, built straight from the maze
+def brute_force_matrices(predictor, length, movements=None):
+    return [predictor.colored_maze.get_direction_matrix(movements[i]) if movements and movements[i]
+            else predictor.random_movement_matrix() for i in range(length)]
+
+
+# The color vector of every step (the floor mask for steps without a reading)
+def brute_force_likelihoods(colored_maze, sensor_readings):
+    return [colored_maze.floor_mask.astype(float) if reading is None else colored_maze.get_color_vector(reading)
+            for reading in sensor_readings]
+
+
+# The filter with the full matrices and no shortcuts, in the same order as the original algorithm
+# Without normalizing, the sum of the state is P(readings | moves) times the sum of the initial state
+def brute_force_solve(predictor, sensor_readings, movements=None, normalize=True):
+    matrices = brute_force_matrices(predictor, len(sensor_readings), movements)
+    likelihoods = brute_force_likelihoods(predictor.colored_maze, sensor_readings)
+    state = predictor.get_initial_state()
+    for matrix, likelihood in zip(matrices, likelihoods):
+        state = likelihood * (matrix @ state)
+        if normalize:
+            state = state / np.sum(state)
+    return state
+
+
+# Forward-backward smoothing with the full matrices: every forward state times the likelihood of the readings after
+#   it, which is carried back with the transposes of the matrices
+def brute_force_smooth(predictor, sensor_readings, movements=None):
+    matrices = brute_force_matrices(predictor, len(sensor_readings), movements)
+    likelihoods = brute_force_likelihoods(predictor.colored_maze, sensor_readings)
+    forward_states = []
+    state = predictor.get_initial_state()
+    for matrix, likelihood in zip(matrices, likelihoods):
+        state = likelihood * (matrix @ state)
+        state = state / np.sum(state)
+        forward_states.append(state)
+
+    smoothed_states = [None] * len(sensor_readings)
+    backward = np.ones(len(state))
+    for t in range(len(sensor_readings) - 1, -1, -1):
+        smoothed_states[t] = forward_states[t] * backward / np.sum(forward_states[t] * backward)
+        backward = matrices[t].T @ (likelihoods[t] * backward)
+        backward = backward / np.sum(backward)
+    return np.array(smoothed_states)
+
+
+# The log probability of the most likely path and the readings, from the max-product filter with the full matrices
+def brute_force_viterbi(predictor, sensor_readings, movements=None):
+    matrices = brute_force_matrices(predictor, len(sensor_readings), movements)
+    likelihoods = brute_force_likelihoods(predictor.colored_maze, sensor_readings)
+    initial_state = predictor.get_initial_state()
+    with np.errstate(divide="ignore"):
+        best_log_probs = np.log(initial_state / np.sum(initial_state))
+        for matrix, likelihood in zip(matrices, likelihoods):
+            best_log_probs = np.max(np.log(matrix) + best_log_probs, axis=1) + np.log(likelihood)
+    return np.max(best_log_probs)
+
+
+# The log probability of a path of locations (after every reading) and the readings, with the full matrices. The
+#   location before the first reading is the most likely one
+def path_log_probability(predictor, path, sensor_readings, movements=None):
+    matrices = brute_force_matrices(predictor, len(sensor_readings), movements)
+    likelihoods = brute_force_likelihoods(predictor.colored_maze, sensor_readings)
+    initial_state = predictor.get_initial_state()
+    with np.errstate(divide="ignore"):
+        log_prob = np.max(np.log(matrices[0][path[0]]) + np.log(initial_state / np.sum(initial_state)))
+        log_prob += np.log(likelihoods[0][path[0]])
+        for t in range(1, len(path)):
+            log_prob += np.log(matrices[t][path[t], path[t - 1]]) + np.log(likelihoods[t][path[t]])
+    return log_prob
+
+
+# Runs of the same (reading, move) pair with random lengths, readings (or none) and moves (or a random move)
+def random_runs(num_runs, max_length):
+    readings, moves = [], []
+    for _ in range(num_runs):
+        length = random.randint(1, max_length)
+        readings += [random.choice([None, "r", "g", "b", "y"])] * length
+        moves += [random.choice([None, "N", "E", "S", "W"])] * length
+    return readings, moves
+
+
+def random_readings(length, missing_chance=0.0):
+    return [None if random.random() < missing_chance else random.choice("rgby") for _ in range(length)]
+
+
+def random_moves(length, unknown_chance=0.0):
+    return [None if random.random() < unknown_chance else random.choice("NESW") for _ in range(length)]
+
+
+for maze_name in sorted(os.listdir(maze_folder)):
+    colored_maze = ColoredMaze(maze_folder + maze_name)
+    dense = FilteringMazePredictor(colored_maze, "dense")
+    backends = [FilteringMazePredictor(colored_maze, backend) for backend in FilteringMazePredictor.BACKENDS]
+    floor_predictors = [FloorFilteringMazePredictor(colored_maze, backend)
+                        for backend in FloorFilteringMazePredictor.BACKENDS]
+    component_filter = ComponentFilter(colored_maze)
+    # Without pruning, and sparse from the first step on, the tracker has to match the dense filter exactly
+    sparse_tracker = SparseBeliefTracker(dense, threshold=0.0, dense_fraction=2.0)
+    particle_filter = ParticleFilter(colored_maze, num_particles, seed=0)
+    particle_estimates, particle_expected = [], []
+    # Small enough that older prefixes get evicted along the way
+    prefix_cache = PrefixBeliefCache(dense, max_entries=8, store_every=4)
+    decoder = ViterbiDecoder(dense)
+    floor_decoder = ViterbiDecoder(floor_predictors[0])
+    lumped_filter = LumpedFilter(colored_maze)
+    random_lumped_filter = LumpedFilter(colored_maze, directional=False)
+    # No window is ever small enough, so the exact search runs on the whole maze and nothing is ever dropped
+    multi_filter = MultiResolutionFilter(colored_maze, block_size=4, max_window_fraction=0.0)
+
+    # Random moves, known moves, a mix of both, and readings with a long dropout in the middle
+    cases = []
+    for _ in range(num_sequences):
+        cases.append((random_readings(sequence_length), None))
+        cases.append((random_readings(sequence_length), random_moves(sequence_length)))
+        cases.append((random_readings(sequence_length, 0.2), random_moves(sequence_length, 0.3)))
+        cases.append((random_readings(sequence_length) + [None] * dropout_length + random_readings(sequence_length),
+                      None))
+
+    for case, (readings, moves) in enumerate(cases):
+        name = f"{maze_name} case {case}"
+        expected = dense.solve_for_probability_distribution(readings, moves)
+        check(f"{name}: dense against brute force", expected, brute_force_solve(dense, readings, moves))
+
+        for predictor in backends:
+            check(f"{name}: {predictor.backend}", predictor.solve_for_probability_distribution(readings, moves),
+                  expected)
+            check(f"{name}: {predictor.backend} solve_encoded", predictor.solve_encoded(readings, moves), expected)
+
+        # The scaled filter, with the log-likelihood from the brute force filter without normalizing
+        state, log_likelihood = dense.solve_with_log_likelihood(readings, moves)
+        check(f"{name}: solve_with_log_likelihood", state, expected)
+        unnormalized = brute_force_solve(dense, readings, moves, normalize=False)
+        check(f"{name}: log-likelihood", [log_likelihood],
+              [np.log(np.sum(unnormalized)) - np.log(np.sum(dense.get_initial_state()))])
+
+        # Smoothing, with every smoothed distribution kept and with sqrt(T) checkpoints
+        if len(readings) == sequence_length:
+            expected_smoothed = brute_force_smooth(dense, readings, moves)
+            check(f"{name}: smooth", ForwardBackwardSmoother(dense).smooth(readings, moves), expected_smoothed)
+            for t, smoothed_state in ForwardBackwardSmoother(dense).iter_smoothed(readings, moves):
+                check(f"{name}: iter_smoothed step {t}", smoothed_state, expected_smoothed[t])
+
+        # The most likely path, which has to be as likely as the brute force best path. The floor-only predictor's
+        #   paths are floor ids, and it starts with all of the probability on the floor
+        if len(readings) == sequence_length:
+            path, log_prob = decoder.decode(readings, moves)
+            best_log_prob = brute_force_viterbi(dense, readings, moves)
+            check(f"{name}: Viterbi log probability", [log_prob], [best_log_prob])
+            check(f"{name}: Viterbi path", [path_log_probability(dense, path, readings, moves)], [best_log_prob])
+            floor_path, floor_log_prob = floor_decoder.decode(readings, moves)
+            check(f"{name}: floor-only Viterbi log probability", [floor_log_prob],
+                  [best_log_prob + np.log(np.sum(dense.get_initial_state()))])
+            check(f"{name}: floor-only Viterbi path", [path_log_probability(
+                dense, floor_predictors[0].floor_indices[floor_path], readings, moves)], [best_log_prob])
+
+        # The particle filter, which moves particles with the same operator as the exact filter for known moves
+        if len(readings) == sequence_length:
+            particle_estimates.append(particle_filter.solve_for_probability_distribution(readings, moves))
+            particle_expected.append(expected)
+
+        # The whole sequence, then one that splits off from it part way through, then the whole sequence again, which
+        #   all resume from the beliefs cached for the earlier ones
+        branch_readings = readings[:10] + random_readings(5)
+        branch_moves = moves[:10] + random_moves(5) if moves else None
+        check(f"{name}: prefix cache", prefix_cache.solve_for_probability_distribution(readings, moves), expected)
+        check(f"{name}: prefix cache branch", prefix_cache.solve_for_probability_distribution(
+            branch_readings, branch_moves), dense.solve_for_probability_distribution(branch_readings, branch_moves))
+        check(f"{name}: prefix cache again", prefix_cache.solve_for_probability_distribution(readings, moves), expected)
+
+        # A session fed the readings a few at a time, going back to a snapshot part way through
+        session = FilteringSession(dense)
+        session.extend(readings[:5], moves[:5] if moves else None)
+        snapshot = session.snapshot()
+        session.extend(readings[5:10], moves[5:10] if moves else None)
+        session.restore(snapshot)
+        check(f"{name}: session", session.extend(readings[5:], moves[5:] if moves else None), expected)
+
+        for predictor in floor_predictors:
+            check(f"{name}: floor-only {predictor.backend}",
+                  predictor.to_grid_state(predictor.solve_for_probability_distribution(readings, moves)), expected)
+
+        check(f"{name}: sparse tracker", sparse_tracker.solve_for_probability_distribution(readings, moves), expected)
+        if not sparse_tracker.is_sparse() or sparse_tracker.dropped_mass != 0.0:
+            failures.append(f"{name}: sparse tracker pruning")
+            print(f"FAILED {name}: sparse tracker pruning")
+
+        check(f"{name}: components", component_filter.solve_for_probability_distribution(readings, moves), expected)
+
+        # The lumped filter needs the directional partition for known moves
+        check(f"{name}: lumped", lumped_filter.solve_for_probability_distribution(readings, moves), expected)
+        if moves is None:
+            check(f"{name}: lumped without directions",
+                  random_lumped_filter.solve_for_probability_distribution(readings), expected)
+
+        check(f"{name}: multi-resolution", multi_filter.solve_for_probability_distribution(readings, moves), expected)
+        if multi_filter.window_fraction() != 1.0:
+            failures.append(f"{name}: multi-resolution window")
+            print(f"FAILED {name}: the multi-resolution window should cover the whole maze")
+
+    north_readings = random_readings(5)
+    particle_estimates.append(particle_filter.solve_for_probability_distribution(north_readings, ["N"] * 5))
+    particle_expected.append(dense.solve_for_probability_distribution(north_readings, ["N"] * 5))
+    # The total variation of the stacked beliefs divided by the number of cases is the average over the cases
+    check(f"{maze_name}: particle filter", np.concatenate(particle_estimates) / len(particle_estimates),
+          np.concatenate(particle_expected) / len(particle_expected), particle_tolerance)
+
+    if prefix_cache.stats()["steps_reused"] == 0:
+        failures.append(f"{maze_name}: prefix cache reuse")
+        print(f"FAILED {maze_name}: prefix cache never resumed from a cached prefix")
+    # The maze saved in the binary format, and converted to it from the text file a few spaces at a time, loads back
+    #   the same (and a damaged space code is caught with validate=True)
+    binary_folder = tempfile.mkdtemp()
+    colored_maze.save_binary(os.path.join(binary_folder, "saved"))
+    ColoredMaze.convert_text_to_binary(maze_folder + maze_name, os.path.join(binary_folder, "converted"), chunk_size=7)
+    for binary_name in ("saved", "converted"):
+        binary_maze = ColoredMaze(os.path.join(binary_folder, binary_name), validate=True)
+        if (binary_maze.width, binary_maze.height, binary_maze.robot_loc) != \
+                (colored_maze.width, colored_maze.height, colored_maze.robot_loc) or \
+                not np.array_equal(binary_maze.color_codes, colored_maze.color_codes):
+            failures.append(f"{maze_name}: {binary_name} binary maze")
+            print(f"FAILED {maze_name}: the {binary_name} binary maze is not the same as the text one")
+    with open(os.path.join(binary_folder, "saved"), "r+b") as f:
+        # The last space, just before the robot locations at the end of the file
+        f.seek(-(8 * len(colored_maze.robot_loc) + 1), os.SEEK_END)
+        f.write(bytes([ColoredMaze.WALL_CODE + 1]))
+    try:
+        ColoredMaze(os.path.join(binary_folder, "saved"), validate=True)
+        failures.append(f"{maze_name}: damaged binary maze")
+        print(f"FAILED {maze_name}: the damaged binary maze was not caught")
+    except ValueError:
+        pass
+
+    # The stencil backend has no matrices to hand out
+    for attribute in ("movement_matrix", "direction_matrices"):
+        try:
+            getattr(FilteringMazePredictor(colored_maze, "stencil"), attribute)
+            failures.append(f"{maze_name}: stencil {attribute}")
+            print(f"FAILED {maze_name}: the stencil backend should not have a {attribute}")
+        except ValueError:
+            pass
+
+    check(f"{maze_name}: log-likelihood of no readings", [dense.solve_with_log_likelihood([])[1]], [0.0])
+
+    # Batches of sequences with different lengths, with and without (partly unknown) moves
+    batch_readings = [random_readings(random.randint(0, sequence_length), 0.2) for _ in range(num_sequences)]
+    batch_moves = [random_moves(len(readings), 0.3) for readings in batch_readings]
+    for predictor in backends:
+        for moves in (None, batch_moves):
+            batch = predictor.solve_batch(batch_readings, moves)
+            for b, readings in enumerate(batch_readings):
+                check(f"{maze_name}: {predictor.backend} solve_batch sequence {b}" + (" with moves" if moves else ""),
+                      batch[b], dense.solve_for_probability_distribution(readings, moves[b] if moves else None))
+
+    # Models published to shared memory and attached to again (from this process), with the maze rebuilt from the
+    #   space codes in the shared block
+    readings, moves = random_readings(sequence_length, 0.2), random_moves(sequence_length, 0.3)
+    expected = dense.solve_for_probability_distribution(readings, moves)
+    for predictor in backends + floor_predictors:
+        published = SharedPredictorModel.publish(predictor)
+        attached = SharedPredictorModel.attach(published.descriptor)
+        check(f"{maze_name}: {type(predictor).__name__} {predictor.backend} shared model",
+              attached.predictor.to_grid_state(attached.predictor.solve_for_probability_distribution(readings, moves)),
+              expected)
+        attached.close()
+        published.close()
+        published.unlink()
+
+    # Models saved to an on-disk cache and memory-mapped back in
+    model_cache = ModelCache(tempfile.mkdtemp())
+    for predictor_class in (FilteringMazePredictor, FloorFilteringMazePredictor):
+        for backend in predictor_class.BACKENDS:
+            name = f"{maze_name}: {predictor_class.__name__} {backend} model cache"
+            for attempt in ("built", "loaded"):
+                if (attempt == "loaded") != model_cache.contains(colored_maze, backend, predictor_class):
+                    failures.append(f"{name} contains")
+                    print(f"FAILED {name}: the model should be cached after it is built")
+                predictor = model_cache.load_predictor(colored_maze, backend, predictor_class)
+                if type(predictor) is not predictor_class:
+                    failures.append(f"{name} class")
+                    print(f"FAILED {name}: loaded a {type(predictor).__name__}")
+                check(f"{name} {attempt}", predictor.to_grid_state(
+                    predictor.solve_for_probability_distribution(readings, moves)), expected)
+    model_cache.clear()
+
+    # Long runs of the same step, fast-forwarded with powers of the fused operators (which the second time around
+    #   are already cached)
+    fused_cache = FusedOperatorCache(dense)
+    for sequence in range(num_sequences):
+        readings, moves = random_runs(6, 200)
+        # Known moves can leave no probability on any floor space, and then there is nothing to compare
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = dense.solve_for_probability_distribution(readings, moves)
+        if not np.all(np.isfinite(expected)):
+            continue
+        for attempt in ("", " again"):
+            check(f"{maze_name}: fused operator cache runs {sequence}{attempt}",
+                  fused_cache.solve_for_probability_distribution(readings, moves), expected)
+
+    print(f"Checked {maze_name}")
+
+# The band filter starts worker processes, so it is only checked on a couple of mazes (and not again if the workers
+#   import this script to start up)
+if __name__ == "__main__":
+    for maze_name in ("maze16x16", "quadrants"):
+        colored_maze = ColoredMaze(maze_folder + maze_name)
+        dense = FilteringMazePredictor(colored_maze, "dense")
+        with ParallelBandFilter(FilteringMazePredictor(colored_maze, "stencil"), num_workers=3) as band_filter:
+            for case in range(num_sequences):
+                readings = random_readings(sequence_length, 0.2)
+                moves = random_moves(sequence_length, 0.3) if case % 2 else None
+                check(f"{maze_name} band filter case {case}",
+                      band_filter.solve_for_probability_distribution(readings, moves),
+                      dense.solve_for_probability_distribution(readings, moves))
+        print(f"Checked the band filter on {maze_name}")
+
+# A bigger open maze of one color with a different space in its corner, where every split spreads out one space at
+#   a time. Every space is its own block, except that random moves cannot tell the two sides of the diagonal apart
+corner_size = 64
+corner_codes = np.zeros(corner_size * corner_size, dtype=np.uint8)
+corner_codes[0] = 1
+corner_maze = ColoredMaze.from_codes(corner_codes, corner_size, corner_size)
+for directional, expected_blocks in ((True, corner_size * corner_size), (False, corner_size * (corner_size + 1) // 2)):
+    corner_labels, corner_blocks = corner_maze.get_bisimulation_partition(directional)
+    neighbour_labels = corner_labels[corner_maze.neighbour_table]
+    if not directional:
+        neighbour_labels = np.sort(neighbour_labels, axis=1)
+    # Every block has to move the same way from each of its spaces
+    num_signatures = len(np.unique(np.column_stack((corner_labels, neighbour_labels)), axis=0))
+    if (corner_blocks, num_signatures) != (expected_blocks, expected_blocks):
+        failures.append(f"corner maze partition (directional={directional})")
+        print(f"FAILED corner maze partition (directional={directional}): {corner_blocks} blocks and "
+              f"{num_signatures} signatures, expected {expected_blocks}")
+print("Checked the corner maze partition")
+
+if failures:
+    sys.exit(f"{len(failures)} checks failed")
+print("Every check passed")
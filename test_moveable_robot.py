@@ -2,11 +2,13 @@ import sys
 
 from ColoredMaze import ColoredMaze
 from FilteringMazePredictor import FilteringMazePredictor
+from FilteringSession import FilteringSession
 import random
 
 maze_file_loc = "./mazes/maze1"
 colored_maze = ColoredMaze(maze_file_loc)
 Filterer = FilteringMazePredictor(colored_maze)
+session = FilteringSession(Filterer)
 
 # Put the robot in a random location in the maze
 colored_maze.randomize_robot_location()
@@ -22,8 +24,6 @@ while robot_knows_decision != "y" and robot_knows_decision != "n":
 if robot_knows_decision == "y":
     robot_knows = True
 
-directions = []
-sensor_readings = []
 valid_moves = {'N', 'E', 'S', 'W'}
 direction = input("Enter move from {N, E, S, W} (lowercase allowed) or 'm' to show the current maze and robot:\n")
 direction = direction.upper()
@@ -31,18 +31,16 @@ direction = direction.strip()
 while direction:
     if direction in valid_moves:
         # Make the move
-        directions.append(direction)
         colored_maze.attempt_robot_move(direction)
         # Sense the color
         color_sensed = colored_maze.get_color_faulty(colored_maze.robot_loc[0], colored_maze.robot_loc[1])
-        sensor_readings.append(color_sensed)
         print(f"Attempted to move {direction} and sensed color {color_sensed}")
 
         # Calculate the probability distribution
         if robot_knows:
-            prob_dist = Filterer.solve_for_probability_distribution(sensor_readings, directions)
+            prob_dist = session.update(color_sensed, direction)
         else:
-            prob_dist = Filterer.solve_for_probability_distribution(sensor_readings)
+            prob_dist = session.update(color_sensed)
 
         # Show where we might be:
         colored_maze.illustrate_probabilities(prob_dist)